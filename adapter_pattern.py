@@ -27,6 +27,164 @@
 AudioPlayer 使用适配器类 MediaAdapter 传递所需的音频类型，不需要知道能播放所需格式音频的实际类。AdapterPatternDemo，我们的演示类使用 AudioPlayer 类来播放各种格式。
 """
 import abc
+import mmap
+import os
+import queue
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MediaReader(object):
+    """
+    以内存映射方式读取媒体文件，按块返回 memoryview，不复制字节。
+    迭代返回的块只在取下一块之前有效，需要保留数据时请自行 bytes(chunk)。
+    """
+
+    def __init__(self, filename: str, chunk_size: int = 64 * 1024):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.position = 0
+        with open(filename, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # 空文件无法映射
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b'')
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """移动读取位置"""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> memoryview:
+        """读取至多 size 个字节，返回的 memoryview 需在 close 前释放"""
+        end = self.size if size < 0 else min(self.position + size, self.size)
+        chunk = self._view[self.position:end]
+        self.position = end
+        return chunk
+
+    def __iter__(self) -> typing.Iterator[memoryview]:
+        while self.position < self.size:
+            chunk = self.read(self.chunk_size)
+            try:
+                yield chunk
+            finally:
+                chunk.release()
+
+    def close(self):
+        """关闭映射"""
+        if self._mmap is None:
+            return
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # 仍有未释放的 read() 结果，交给垃圾回收关闭
+            pass
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def stream(filename: str, decode: typing.Callable[[memoryview], None], chunk_size: int = 64 * 1024):
+    """分块将文件交给 decode，文件不存在时只播放文件名"""
+    if not os.path.isfile(filename):
+        return
+    with MediaReader(filename, chunk_size) as reader:
+        for chunk in reader:
+            decode(chunk)
+
+
+def read_media(filename: str, chunk_size: int = 64 * 1024) -> typing.Iterator[memoryview]:
+    """逐块产出文件内容，读完后关闭映射"""
+    with MediaReader(filename, chunk_size) as reader:
+        yield from reader
+
+
+class _Failure(object):
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+class Pipeline(object):
+    """
+    生成器流水线：源和每个阶段各在一个工作线程中运行，阶段之间用有界队列连接。
+    消费者变慢时队列被填满，上游随之阻塞（背压），内存占用不会增长。
+    """
+
+    def __init__(self, source: typing.Iterable, maxsize: int = 8, timeout: float = 0.1):
+        self._source = source
+        self._stages: typing.List[typing.Callable[[typing.Iterable], typing.Iterable]] = []
+        self.maxsize = maxsize
+        self.timeout = timeout
+
+    def pipe(self, stage: typing.Callable[[typing.Iterable], typing.Iterable]) -> 'Pipeline':
+        """追加一个阶段，stage 接收上游迭代器并返回新的迭代器"""
+        self._stages.append(stage)
+        return self
+
+    def _put(self, q: queue.Queue, item, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=self.timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _drain(self, q: queue.Queue, stop: threading.Event) -> typing.Iterator:
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def _run(self, stage: typing.Callable[[typing.Iterable], typing.Iterable], upstream: typing.Iterable,
+             q: queue.Queue, stop: threading.Event):
+        try:
+            for item in stage(upstream):
+                if not self._put(q, item, stop):
+                    return
+        except BaseException as e:
+            self._put(q, _Failure(e), stop)
+        else:
+            self._put(q, _DONE, stop)
+
+    def __iter__(self) -> typing.Iterator:
+        stop = threading.Event()
+        threads = []
+        upstream = self._source
+        for stage in [iter] + self._stages:
+            q = queue.Queue(self.maxsize)
+            threads.append(threading.Thread(target=self._run, args=(stage, upstream, q, stop), daemon=True))
+            upstream = self._drain(q, stop)
+        for t in threads:
+            t.start()
+        try:
+            yield from upstream
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
 
 
 class MediaPlayer(metaclass=abc.ABCMeta):
@@ -36,6 +194,8 @@ class MediaPlayer(metaclass=abc.ABCMeta):
 
 
 class AdvancedMediaPlayer(metaclass=abc.ABCMeta):
+    chunk_size = 64 * 1024
+
     @abc.abstractmethod
     def play_vlc(self, filename: str):
         """播放vlc文件"""
@@ -44,10 +204,23 @@ class AdvancedMediaPlayer(metaclass=abc.ABCMeta):
     def play_mp4(self, filename: str):
         """播放mp4文件"""
 
+    def decode(self, chunk: memoryview):
+        """解码一块数据"""
+
+    def decode_stream(self, chunks: typing.Iterable[memoryview]) -> typing.Iterator[bytes]:
+        """流式解码，产出的数据脱离文件映射"""
+        for chunk in chunks:
+            yield bytes(chunk)
+
+    def encode_stream(self, frames: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+        """流式编码"""
+        yield from frames
+
 
 class VlcPlayer(AdvancedMediaPlayer):
     def play_vlc(self, filename: str):
         print(f"Playing vlc file. Name: {filename}")
+        stream(filename, self.decode, self.chunk_size)
 
     def play_mp4(self, filename: str):
         """播放mp4文件"""
@@ -59,25 +232,94 @@ class Mp4Player(AdvancedMediaPlayer):
 
     def play_mp4(self, filename: str):
         print(f"Playing mp4 file. Name: {filename}")
+        stream(filename, self.decode, self.chunk_size)
 
 
 class MediaAdapter(MediaPlayer):
+    """
+    按格式注册播放方法，播放器实例只创建一次并被复用，新格式通过 register 接入。
+    """
+
+    def __init__(self):
+        self._players: typing.Dict[str, typing.Callable[[str], None]] = {}
+        self._codecs: typing.Dict[str, AdvancedMediaPlayer] = {}
+        vlc_player, mp4_player = VlcPlayer(), Mp4Player()
+        self.register('vlc', vlc_player.play_vlc, vlc_player)
+        self.register('mp4', mp4_player.play_mp4, mp4_player)
+
+    def register(self, audio_type: str, play: typing.Callable[[str], None], codec: AdvancedMediaPlayer = None):
+        """注册格式对应的播放方法，提供 codec 时该格式可参与转码"""
+        self._players[audio_type] = play
+        if codec is not None:
+            self._codecs[audio_type] = codec
+
+    def get(self, audio_type: str) -> typing.Optional[typing.Callable[[str], None]]:
+        """获取格式对应的播放方法，不支持时返回 None"""
+        return self._players.get(audio_type)
+
     def play(self, audio_type: str, filename: str):
-        if audio_type == 'vlc':
-            VlcPlayer().play_vlc(filename)
-        elif audio_type == 'mp4':
-            Mp4Player().play_mp4(filename)
+        play = self._players.get(audio_type)
+        if play is not None:
+            play(filename)
+
+    def transcode(self, src_type: str, filename: str, dst_type: str, output: str,
+                  stages: typing.Sequence[typing.Callable[[typing.Iterable], typing.Iterable]] = (),
+                  chunk_size: int = 64 * 1024, maxsize: int = 8) -> int:
+        """
+        流式转码：解码 src_type -> stages（如重采样） -> 编码 dst_type -> 写入 output。
+        :return: 写入的字节数
+        """
+        decoder, encoder = self._codecs[src_type], self._codecs[dst_type]
+        pipeline = Pipeline(decoder.decode_stream(read_media(filename, chunk_size)), maxsize)
+        for stage in stages:
+            pipeline.pipe(stage)
+        pipeline.pipe(encoder.encode_stream)
+        written = 0
+        with open(output, 'wb') as f:
+            for data in pipeline:
+                written += f.write(data)
+        return written
+
+    def transcode_batch(self, jobs: typing.Iterable[typing.Tuple[str, str, str, str]], max_workers: int = 4,
+                        **kwargs) -> typing.List[int]:
+        """通过有界线程池批量转码 (src_type, filename, dst_type, output) 列表"""
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(lambda job: self.transcode(*job, **kwargs), jobs))
 
 
 class AudioPlayer(MediaPlayer):
+    chunk_size = 64 * 1024
+
+    def __init__(self, adapter: MediaAdapter = None):
+        self.adapter = adapter if adapter is not None else MediaAdapter()
+        # mp3 与其他格式一样放在注册表中，可以被 register 替换
+        if self.adapter.get('mp3') is None:
+            self.adapter.register('mp3', self.play_mp3)
+
+    def play_mp3(self, filename: str):
+        print(f"Playing mp3 file. Name: {filename}")
+        stream(filename, self.decode, self.chunk_size)
+
+    def decode(self, chunk: memoryview):
+        """解码一块 mp3 数据"""
+
+    def register(self, audio_type: str, play: typing.Callable[[str], None]):
+        """接入新格式"""
+        self.adapter.register(audio_type, play)
+
     def play(self, audio_type: str, filename: str):
-        if audio_type == 'mp3':
-            print(f"Playing mp3 file. Name: {filename}")
-        elif audio_type in ['vlc', 'mp4']:
-            MediaAdapter().play(audio_type, filename)
+        play = self.adapter.get(audio_type)
+        if play is not None:
+            play(filename)
         else:
             print(f"Invalid media. {audio_type} format not supported")
 
+    def play_list(self, playlist: typing.Iterable[typing.Tuple[str, str]], max_workers: int = 4):
+        """通过有界线程池批量播放 (audio_type, filename) 列表"""
+        with ThreadPoolExecutor(max_workers) as executor:
+            for _ in executor.map(lambda item: self.play(*item), playlist):
+                pass
+
 
 if __name__ == '__main__':
     audio_player = AudioPlayer()
@@ -85,3 +327,5 @@ if __name__ == '__main__':
     audio_player.play("mp4", "alone.mp4")
     audio_player.play("vlc", "far far away.vlc")
     audio_player.play("avi", "mind me.avi")
+    print()
+    audio_player.play_list([("mp3", "a.mp3"), ("mp4", "b.mp4"), ("vlc", "c.vlc")], max_workers=2)
@@ -23,7 +23,20 @@
 Broker 对象使用命令模式，基于命令的类型确定哪个对象执行哪个命令。CommandPatternDemo，我们的演示类使用 Broker 类来演示命令模式。
 """
 import abc
+import asyncio
+import collections
+import heapq
+import json
+import os
+import random
+import threading
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IrreversibleOrder(Exception):
+    """命令无法撤销"""
 
 
 class Order(metaclass=abc.ABCMeta):
@@ -31,44 +44,844 @@ class Order(metaclass=abc.ABCMeta):
     def execute(self):
         """执行"""
 
+    def inverse(self) -> 'Order':
+        """返回抵消本命令效果的命令，无法撤销时抛出 IrreversibleOrder"""
+        raise IrreversibleOrder(f'{type(self).__name__} is not reversible')
+
+    def undo(self):
+        """撤销"""
+        self.inverse().execute()
+
+
+class Fill(typing.NamedTuple):
+    """成交：maker 为挂单方，taker 为吃单方"""
+    maker_id: int
+    taker_id: int
+    price: float
+    quantity: int
+
+
+class OrderBook(object):
+    """
+    限价订单簿：买卖价格档位分别放在堆中，每个档位内的挂单按先进先出排队。
+    撮合每个订单时只有新增/清空价格档位需要 O(log n) 的堆操作。
+    """
+
+    def __init__(self):
+        # 买方堆存放负价格，使堆顶为最高买价
+        self._bids: typing.List[float] = []
+        self._asks: typing.List[float] = []
+        self._bid_levels: typing.Dict[float, typing.Deque[typing.List[int]]] = {}
+        self._ask_levels: typing.Dict[float, typing.Deque[typing.List[int]]] = {}
+        self._next_id = 0
+
+    @property
+    def best_bid(self) -> typing.Optional[float]:
+        return -self._bids[0] if self._bids else None
+
+    @property
+    def best_ask(self) -> typing.Optional[float]:
+        return self._asks[0] if self._asks else None
+
+    def depth(self, side: str) -> typing.List[typing.Tuple[float, int]]:
+        """按价格优先返回某一方各档位的 (价格, 挂单量)"""
+        levels = self._bid_levels if side == 'buy' else self._ask_levels
+        prices = sorted(levels, reverse=side == 'buy')
+        return [(price, sum(entry[1] for entry in levels[price])) for price in prices]
+
+    def submit(self, side: str, quantity: int, price: float) -> typing.Tuple[int, typing.List[Fill]]:
+        """
+        提交限价单，先与对手方撮合，剩余数量挂在订单簿上。
+        :return: (订单号, 成交列表)
+        """
+        self._next_id += 1
+        order_id = self._next_id
+        if side == 'buy':
+            heap, levels, sign = self._asks, self._ask_levels, 1
+            own_heap, own_levels, own_sign = self._bids, self._bid_levels, -1
+        else:
+            heap, levels, sign = self._bids, self._bid_levels, -1
+            own_heap, own_levels, own_sign = self._asks, self._ask_levels, 1
+        fills = []
+        # 对手方最优价可成交时持续撮合
+        while quantity and heap and heap[0] <= sign * price:
+            level_price = sign * heap[0]
+            level = levels[level_price]
+            while quantity and level:
+                maker = level[0]
+                traded = min(quantity, maker[1])
+                fills.append(Fill(maker[0], order_id, level_price, traded))
+                quantity -= traded
+                maker[1] -= traded
+                if not maker[1]:
+                    level.popleft()
+            if not level:
+                heapq.heappop(heap)
+                del levels[level_price]
+        if quantity:
+            level = own_levels.get(price)
+            if level is None:
+                level = own_levels[price] = collections.deque()
+                heapq.heappush(own_heap, own_sign * price)
+            level.append([order_id, quantity])
+        return order_id, fills
+
 
 class Stock(object):
     name = 'ABC'
     quantity = 10
 
-    def buy(self):
-        print(f"Stock: [Name: {self.name}, Quantity: {self.quantity}] bought")
+    def __init__(self, name: str = None, quantity: int = None):
+        if name is not None:
+            self.name = name
+        if quantity is not None:
+            self.quantity = quantity
+        self.book = OrderBook()
+
+    def buy(self, quantity: int = None, price: float = None) -> typing.List[Fill]:
+        """买入，给出 price 时作为限价单进入订单簿撮合"""
+        quantity = self.quantity if quantity is None else quantity
+        if price is not None:
+            return self.book.submit('buy', quantity, price)[1]
+        print(f"Stock: [Name: {self.name}, Quantity: {quantity}] bought")
+        return []
 
-    def sell(self):
-        print(f"Stock: [Name: {self.name}, Quantity: {self.quantity}] sold")
+    def sell(self, quantity: int = None, price: float = None) -> typing.List[Fill]:
+        """卖出，给出 price 时作为限价单进入订单簿撮合"""
+        quantity = self.quantity if quantity is None else quantity
+        if price is not None:
+            return self.book.submit('sell', quantity, price)[1]
+        print(f"Stock: [Name: {self.name}, Quantity: {quantity}] sold")
+        return []
 
 
 class BuyStock(Order):
-    def __init__(self, stock: Stock):
+    def __init__(self, stock: Stock, quantity: int = None, price: float = None):
         self.stock = stock
+        self.quantity = stock.quantity if quantity is None else quantity
+        self.price = price
+        self.fills: typing.List[Fill] = []
 
     def execute(self):
-        self.stock.buy()
+        if self.price is None:
+            self.stock.buy(self.quantity)
+        else:
+            self.fills = self.stock.buy(self.quantity, self.price)
+
+    def inverse(self) -> Order:
+        if self.price is not None:
+            raise IrreversibleOrder('limit orders are not reversible')
+        return SellStock(self.stock, self.quantity)
 
 
 class SellStock(Order):
-    def __init__(self, stock: Stock):
+    def __init__(self, stock: Stock, quantity: int = None, price: float = None):
         self.stock = stock
+        self.quantity = stock.quantity if quantity is None else quantity
+        self.price = price
+        self.fills: typing.List[Fill] = []
 
     def execute(self):
-        self.stock.sell()
+        if self.price is None:
+            self.stock.sell(self.quantity)
+        else:
+            self.fills = self.stock.sell(self.quantity, self.price)
+
+    def inverse(self) -> Order:
+        if self.price is not None:
+            raise IrreversibleOrder('limit orders are not reversible')
+        return BuyStock(self.stock, self.quantity)
+
+
+class NettingStats(object):
+    """订单轧差统计"""
+
+    def __init__(self):
+        self.received = 0
+        self.executed = 0
+
+    @property
+    def collapsed(self) -> int:
+        return self.received - self.executed
+
+    @property
+    def ratio(self) -> float:
+        """收到的订单数与实际执行数之比"""
+        return self.received / self.executed if self.executed else 0.0
+
+    def __repr__(self):
+        return f'NettingStats(received={self.received}, executed={self.executed}, collapsed={self.collapsed})'
+
+
+def net_orders(orders: typing.Iterable[Order]) -> typing.List[Order]:
+    """
+    按股票轧差：同一股票的 BuyStock 与 SellStock 相互抵消，只保留一条净额订单，净额为 0 时不产生订单。
+    限价单和其他类型的订单原样保留，并作为该股票的分界，分界前后的订单不会合并。
+    """
+    netted: typing.List[Order] = []
+    nets: typing.Dict[Stock, int] = {}
+
+    def flush(stock: Stock):
+        quantity = nets.pop(stock)
+        if quantity > 0:
+            netted.append(BuyStock(stock, quantity))
+        elif quantity < 0:
+            netted.append(SellStock(stock, -quantity))
+
+    for order in orders:
+        kind = type(order) if getattr(order, 'price', None) is None else None
+        if kind is BuyStock:
+            nets[order.stock] = nets.get(order.stock, 0) + order.quantity
+        elif kind is SellStock:
+            nets[order.stock] = nets.get(order.stock, 0) - order.quantity
+        else:
+            stock = getattr(order, 'stock', None)
+            if stock in nets:
+                flush(stock)
+            netted.append(order)
+    for stock in list(nets):
+        flush(stock)
+    return netted
+
+
+class OrderJournal(object):
+    """
+    只追加的订单日志（write-ahead journal），每行一条订单或一个检查点。
+    写入线程做组提交：一次 write + fsync 覆盖一批订单，append 只入队不等待落盘，
+    订单只有在 wait 返回后才算持久化，执行订单前必须先 wait。
+    """
+    order_types: typing.Dict[str, typing.Type[Order]] = {'BuyStock': BuyStock, 'SellStock': SellStock}
+
+    def __init__(self, path: str, batch_size: int = 4096, flush_interval: float = 0.002, fsync: bool = True,
+                 on_commit: typing.Callable[[int], None] = None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.on_commit = on_commit
+        self.seq = 0
+        self.durable = 0
+        # (写入该行后已落盘的序号, 行)
+        self._pending: typing.Deque[typing.Tuple[int, str]] = collections.deque()
+        self._closed = False
+        self._error: typing.Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._has_pending = threading.Condition(self._lock)
+        self._committed = threading.Condition(self._lock)
+        self._file = open(path, 'ab')
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def recover(self, stocks: typing.Dict[str, Stock] = None) -> typing.List[Order]:
+        """读取日志，返回最后一个检查点之后尚未执行的订单，须在追加订单之前调用"""
+        stocks = stocks if stocks is not None else {}
+        records: typing.List[typing.Tuple[int, str, str, int, typing.Optional[float]]] = []
+        placed = 0
+        size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 崩溃时写了一半的行
+                    break
+                size += len(line)
+                fields = line.decode('utf-8').rstrip('\n').split('\t')
+                if fields[0] == 'O':
+                    price = float(fields[5]) if fields[5] else None
+                    records.append((int(fields[1]), fields[2], fields[3], int(fields[4]), price))
+                elif fields[0] == 'C':
+                    placed = max(placed, int(fields[1]))
+        # 截掉残缺的尾部，之后的追加从完整的行开始
+        os.truncate(self.path, size)
+        orders = []
+        for seq, order_type, name, quantity, price in records:
+            if seq <= placed:
+                continue
+            stock = stocks.get(name)
+            if stock is None:
+                stock = stocks[name] = Stock(name, quantity)
+            orders.append(self.order_types[order_type](stock, quantity, price))
+        with self._lock:
+            last = records[-1][0] if records else 0
+            self.seq = self.durable = max(self.seq, last, placed)
+        return orders
+
+    def append(self, order: Order) -> int:
+        """追加订单，返回序号"""
+        name = order.stock.name
+        price = '' if order.price is None else repr(float(order.price))
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            self.seq += 1
+            self._pending.append(
+                (self.seq, f'O\t{self.seq}\t{type(order).__name__}\t{name}\t{order.quantity}\t{price}\n'))
+            # 第一条唤醒写入线程开始计时，攒够一批时提前唤醒
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._has_pending.notify()
+            return self.seq
+
+    def checkpoint(self, seq: int) -> int:
+        """记录 seq 及之前的订单均已执行"""
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            self._pending.append((self.seq, f'C\t{seq}\n'))
+            self._has_pending.notify()
+            return self.seq
+
+    def wait(self, seq: int, timeout: float = None) -> bool:
+        """等待 seq 落盘，写入线程出错时抛出该错误"""
+        with self._lock:
+            done = self._committed.wait_for(lambda: self.durable >= seq or self._error is not None, timeout)
+            if self.durable < seq and self._error is not None:
+                raise self._error
+            return done
+
+    def _write(self):
+        try:
+            self._write_batches()
+        except BaseException as e:
+            with self._lock:
+                self._error = e
+                self._committed.notify_all()
+
+    def _write_batches(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._has_pending.wait()
+                if len(self._pending) < self.batch_size and not self._closed:
+                    # 等待攒够一批或超时
+                    self._has_pending.wait(self.flush_interval)
+                if not self._pending and self._closed:
+                    return
+                # 一次 fsync 最多提交 batch_size 行
+                popleft = self._pending.popleft
+                batch = [popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            seq = batch[-1][0]
+            self._file.write(''.join(line for _, line in batch).encode('utf-8'))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            with self._lock:
+                self.durable = seq
+                self._committed.notify_all()
+            if self.on_commit is not None:
+                self.on_commit(seq)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._has_pending.notify()
+        self._thread.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class Broker(object):
-    orders: typing.List[Order] = []
+    """
+    每个 Broker 拥有自己的线程安全订单队列，place_orders 按股票把订单分片交给线程池执行：
+    同一股票的订单保持先后顺序，不同股票的订单并行执行。
+    提供 journal 时订单先写入日志并等待落盘后才执行，执行后写检查点，重启后用 recover 恢复未执行的订单。
+    coalesce 为 True 时执行前按股票轧差，只执行净额订单，统计见 stats。
+    history 大于 0 时保留最近 history 条已执行命令用于 undo/redo，每次下单各占一条；
+    历史满时先把较旧一半中相邻的同一股票命令压缩为一条净额命令，压缩不了才丢弃最旧的命令。
+    """
 
-    def take_order(self, order: Order):
-        self.orders.append(order)
+    def __init__(self, max_workers: int = 4, journal: OrderJournal = None, coalesce: bool = False,
+                 history: int = 0):
+        self.orders: typing.Deque[Order] = collections.deque()
+        self.max_workers = max_workers
+        self.journal = journal
+        self.coalesce = coalesce
+        self.stats = NettingStats()
+        self.history: typing.Deque[Order] = collections.deque(maxlen=history)
+        self.redo_history: typing.Deque[Order] = collections.deque(maxlen=history)
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+        self._placing = threading.Lock()
+        self._taking = threading.Lock()
 
-    def place_orders(self):
-        for order in self.orders:
+    def take_order(self, order: Order) -> typing.Optional[int]:
+        """接受订单，有日志时返回日志序号"""
+        if self.journal is None:
+            self.orders.append(order)
+            return None
+        with self._taking:
+            seq = self.journal.append(order)
+            self.orders.append(order)
+        return seq
+
+    def recover(self, stocks: typing.Dict[str, Stock] = None) -> int:
+        """从日志恢复未执行的订单，返回恢复的数量"""
+        orders = self.journal.recover(stocks)
+        self.orders.extend(orders)
+        return len(orders)
+
+    def _drain(self) -> typing.List[Order]:
+        orders = []
+        popleft = self.orders.popleft
+        while True:
+            try:
+                orders.append(popleft())
+            except IndexError:
+                return orders
+
+    @staticmethod
+    def _execute(orders: typing.List[Order]):
+        for order in orders:
             order.execute()
-        self.orders.clear()
+
+    def place_orders(self):
+        with self._placing:
+            if self.journal is None:
+                orders = self._drain()
+            else:
+                with self._taking:
+                    seq = self.journal.seq
+                    orders = self._drain()
+            if not orders:
+                return
+            if self.journal is not None:
+                # 先落盘再执行，崩溃后执行过的订单一定能在日志中找到；组提交仍摊薄 fsync
+                self.journal.wait(seq)
+            if self.coalesce:
+                self.stats.received += len(orders)
+                orders = net_orders(orders)
+                self.stats.executed += len(orders)
+            self._dispatch(orders)
+            if self.journal is not None:
+                self.journal.checkpoint(seq)
+            if self.history.maxlen:
+                self.redo_history.clear()
+                self._record(orders)
+
+    def _record(self, orders: typing.Iterable[Order]):
+        """记入历史，历史已满时先压缩旧的部分"""
+        history = self.history
+        for order in orders:
+            if len(history) == history.maxlen:
+                self._compact()
+            history.append(order)
+
+    def _compact(self):
+        """把较旧一半中第一对可以轧差的相邻同一股票命令合并为一条，最近的命令保持独立"""
+        history = self.history
+        for index in range(len(history) // 2):
+            older, newer = history[index], history[index + 1]
+            if getattr(older, 'stock', None) is not getattr(newer, 'stock', None):
+                continue
+            merged = net_orders((older, newer))
+            if len(merged) < 2:
+                del history[index + 1]
+                del history[index]
+                for order in reversed(merged):
+                    history.insert(index, order)
+                return
+
+    def undo(self, steps: int = 1) -> int:
+        """
+        撤销最近 steps 条历史命令，多条命令的逆命令先按股票轧差再执行。
+        :return: 实际撤销的条数
+        """
+        with self._placing:
+            orders = [self.history.pop() for _ in range(min(steps, len(self.history)))]
+            try:
+                inverses = net_orders(order.inverse() for order in orders)
+            except IrreversibleOrder:
+                self.history.extend(reversed(orders))
+                raise
+            for order in inverses:
+                order.execute()
+            self.redo_history.extend(orders)
+            return len(orders)
+
+    def redo(self, steps: int = 1) -> int:
+        """
+        重做最近撤销的 steps 条命令。
+        :return: 实际重做的条数
+        """
+        with self._placing:
+            orders = [self.redo_history.pop() for _ in range(min(steps, len(self.redo_history)))]
+            for order in net_orders(orders):
+                order.execute()
+            self._record(orders)
+            return len(orders)
+
+    def _dispatch(self, orders: typing.List[Order]):
+        if self.max_workers <= 1:
+            self._execute(orders)
+            return
+        shards = [[] for _ in range(self.max_workers)]
+        for order in orders:
+            shards[hash(getattr(order, 'stock', None)) % self.max_workers].append(order)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+        futures = [self._executor.submit(self._execute, shard) for shard in shards if shard]
+        for future in futures:
+            future.result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ExchangeServer(object):
+    """
+    本地交易所替身，供测试和延迟基准离线使用。
+    每行一个 JSON 帧 {"id": 帧号, "orders": [[类型, 股票, 数量, 价格], ...]}，按收到的顺序逐帧回复
+    {"id": 帧号, "fills": [[[maker_id, taker_id, price, quantity], ...], ...]}，无价格的订单直接确认。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.books: typing.Dict[str, OrderBook] = {}
+        self.frames = 0
+        self.orders = 0
+        self._server = None
+
+    async def start(self) -> 'ExchangeServer':
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def execute(self, order_type: str, name: str, quantity: int, price: typing.Optional[float]) -> list:
+        """执行一条订单，返回成交"""
+        if price is None:
+            return []
+        book = self.books.get(name)
+        if book is None:
+            book = self.books[name] = OrderBook()
+        side = 'buy' if order_type == 'BuyStock' else 'sell'
+        return [list(fill) for fill in book.submit(side, quantity, price)[1]]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                frame = json.loads(line)
+                fills = [self.execute(*order) for order in frame['orders']]
+                self.frames += 1
+                self.orders += len(fills)
+                writer.write(json.dumps({'id': frame['id'], 'fills': fills}).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+class _ExchangeConnection(object):
+    """交易所连接：帧可以连续发送（流水线），回复按帧号交给等待的 future"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.pending: typing.Dict[int, typing.List[typing.Tuple[Order, asyncio.Future]]] = {}
+        self._task = asyncio.ensure_future(self._read())
+
+    @staticmethod
+    def _fail(batch: typing.List[typing.Tuple[Order, asyncio.Future]], error: BaseException):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def send(self, frame_id: int, batch: typing.List[typing.Tuple[Order, asyncio.Future]]):
+        """发送一帧，写缓冲区过大时等待交易所读取"""
+        if self._task.done():
+            # 读取任务已因连接断开退出，不会再有回复
+            self._fail(batch, ConnectionError('exchange connection closed'))
+            return
+        self.pending[frame_id] = batch
+        orders = [[type(order).__name__, order.stock.name, order.quantity, order.price] for order, _ in batch]
+        try:
+            self.writer.write(json.dumps({'id': frame_id, 'orders': orders}).encode() + b'\n')
+            await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            self._fail(self.pending.pop(frame_id, []), e)
+
+    async def _read(self):
+        error: BaseException = ConnectionError('exchange connection closed')
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                reply = json.loads(line)
+                for (order, future), fills in zip(self.pending.pop(reply['id']), reply['fills']):
+                    order.fills = [Fill(*fill) for fill in fills]
+                    if not future.done():
+                        future.set_result(order.fills)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            for batch in self.pending.values():
+                self._fail(batch, error)
+            self.pending.clear()
+
+    async def close(self):
+        self.writer.close()
+        await self._task
+
+
+class AsyncBroker(object):
+    """
+    asyncio 版 Broker：订单在 max_delay 内合并为多订单帧，轮流经少量 TCP 连接发往交易所，
+    发送后不等待回复即可继续发送下一帧。
+    """
+
+    def __init__(self, host: str, port: int, connections: int = 2, max_batch: int = 256, max_delay: float = 0.0005):
+        self.host = host
+        self.port = port
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.connections: typing.List[_ExchangeConnection] = [None] * connections
+        self.frames = 0
+        self._queue: typing.Optional[asyncio.Queue] = None
+        self._task = None
+
+    async def connect(self) -> 'AsyncBroker':
+        for i in range(len(self.connections)):
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            self.connections[i] = _ExchangeConnection(reader, writer)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._collect())
+        return self
+
+    def take_order(self, order: Order) -> asyncio.Future:
+        """提交订单，返回的 future 在交易所回复后得到成交列表"""
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((order, future))
+        return future
+
+    async def place_orders(self, orders: typing.Iterable[Order]) -> typing.List[typing.List[Fill]]:
+        return await asyncio.gather(*[self.take_order(order) for order in orders])
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    self._queue.put_nowait(None)
+                    break
+                batch.append(item)
+            frame_id = self.frames
+            self.frames += 1
+            await self.connections[frame_id % len(self.connections)].send(frame_id, batch)
+
+    async def close(self):
+        self._queue.put_nowait(None)
+        await self._task
+        for connection in self.connections:
+            await connection.close()
+
+
+def check_async_broker():
+    """对本地交易所替身检查成交回报，以及连接断开后订单立即失败而不是一直等待"""
+
+    async def run():
+        server = await ExchangeServer().start()
+        broker = await AsyncBroker(server.host, server.port, connections=1).connect()
+        stock = Stock('S')
+        assert await broker.take_order(SellStock(stock, 5, 100)) == []
+        fills = await broker.take_order(BuyStock(stock, 3, 101))
+        assert fills == [Fill(1, 2, 100.0, 3)]
+        assert await broker.place_orders([BuyStock(stock, 1), SellStock(stock, 1)]) == [[], []]
+
+        broker.connections[0].writer.transport.abort()
+        await asyncio.sleep(0.01)
+        for order in (BuyStock(stock, 1, 99), BuyStock(stock, 1, 98)):
+            try:
+                await asyncio.wait_for(broker.take_order(order), 1)
+            except ConnectionError:
+                pass
+            else:
+                raise AssertionError('order on a lost connection should fail')
+        await broker.close()
+        await server.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def benchmark_async(orders: int = 100000, concurrency: int = 1000, connections: int = 2):
+    """AsyncBroker 对本地交易所替身的吞吐量与延迟基准"""
+
+    async def run():
+        server = await ExchangeServer().start()
+        broker = await AsyncBroker(server.host, server.port, connections).connect()
+        loop = asyncio.get_event_loop()
+        rng = random.Random(0)
+        stocks = [Stock(f'S{i}') for i in range(10)]
+        latencies = []
+
+        async def submit(order: Order):
+            began = loop.time()
+            await broker.take_order(order)
+            latencies.append(loop.time() - began)
+
+        start = loop.time()
+        for offset in range(0, orders, concurrency):
+            await asyncio.gather(*[
+                submit((BuyStock if rng.random() < 0.5 else SellStock)(
+                    rng.choice(stocks), rng.randint(1, 100), 10000 + rng.randint(-50, 50)))
+                for _ in range(min(concurrency, orders - offset))])
+        elapsed = loop.time() - start
+        await broker.close()
+        await server.close()
+        latencies.sort()
+        print(f'async broker: {orders / elapsed:.0f} orders/s, {orders / broker.frames:.1f} orders/frame, '
+              f'p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms')
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def benchmark(orders: int = 1000000, stocks: int = 100, max_workers: int = 4):
+    """BuyStock/SellStock 吞吐量基准"""
+
+    class CountingStock(Stock):
+        def __init__(self, name: str):
+            self.name = name
+            self.executed = 0
+
+        def buy(self, quantity: int = None, price: float = None):
+            self.executed += 1
+
+        def sell(self, quantity: int = None, price: float = None):
+            self.executed += 1
+
+    pool = [CountingStock(f'S{i}') for i in range(stocks)]
+    with Broker(max_workers) as broker:
+        start = time.perf_counter()
+        for i in range(orders):
+            stock = pool[i % stocks]
+            broker.take_order(BuyStock(stock) if i & 1 else SellStock(stock))
+        taken = time.perf_counter()
+        broker.place_orders()
+        placed = time.perf_counter()
+    assert sum(stock.executed for stock in pool) == orders
+    print(f'take_order: {orders / (taken - start):.0f} orders/s, '
+          f'place_orders: {orders / (placed - taken):.0f} orders/s')
+
+
+def benchmark_journal(orders: int = 200000, batch_sizes: typing.Sequence[int] = (1, 64, 1024, 8192)):
+    """订单日志吞吐量基准，以及批大小对提交延迟的影响"""
+    import tempfile
+
+    stock = Stock()
+    order = BuyStock(stock)
+    for batch_size in batch_sizes:
+        # 小批量时每条订单都要 fsync，按批大小缩减订单数以控制耗时
+        count = min(orders, batch_size * 256)
+        with tempfile.TemporaryDirectory() as directory:
+            appended = [0.0] * (count + 1)
+            latencies = []
+            committed = [0]
+
+            def on_commit(seq: int):
+                now = time.perf_counter()
+                latencies.extend(now - appended[i] for i in range(committed[0] + 1, seq + 1))
+                committed[0] = seq
+
+            journal = OrderJournal(os.path.join(directory, 'orders.journal'), batch_size, on_commit=on_commit)
+            start = time.perf_counter()
+            for _ in range(count):
+                appended[journal.seq + 1] = time.perf_counter()
+                seq = journal.append(order)
+            journal.wait(seq)
+            elapsed = time.perf_counter() - start
+            journal.close()
+            latencies.sort()
+            print(f'batch {batch_size:>5}: {count:>6} orders, {count / elapsed:>9.0f} orders/s, '
+                  f'p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms, '
+                  f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms')
+
+
+def check_book():
+    """检查订单簿双向撮合、跨档位部分成交以及不会出现交叉盘口"""
+    book = OrderBook()
+    bid_id, fills = book.submit('buy', 10, 100)
+    assert not fills
+    sell_id, fills = book.submit('sell', 5, 99)
+    assert fills == [Fill(bid_id, sell_id, 100, 5)]
+    assert book.best_bid == 100 and book.best_ask is None
+
+    book = OrderBook()
+    first, _ = book.submit('sell', 3, 101)
+    second, _ = book.submit('sell', 4, 101)
+    third, _ = book.submit('sell', 5, 102)
+    buy_id, fills = book.submit('buy', 10, 102)
+    assert fills == [Fill(first, buy_id, 101, 3), Fill(second, buy_id, 101, 4), Fill(third, buy_id, 102, 3)]
+    assert book.depth('sell') == [(102, 2)] and book.best_bid is None
+
+    first, _ = book.submit('buy', 2, 100)
+    second, _ = book.submit('buy', 6, 99)
+    sell_id, fills = book.submit('sell', 5, 98)
+    assert fills == [Fill(first, sell_id, 100, 2), Fill(second, sell_id, 99, 3)]
+    assert book.depth('buy') == [(99, 3)] and book.best_bid < book.best_ask
+
+
+def benchmark_book(orders: int = 1000000, mid: int = 10000, spread: int = 50, seed: int = 0):
+    """订单簿撮合基准：合成行情下的吞吐量与延迟分位数"""
+    rng = random.Random(seed)
+    feed = [('buy' if rng.random() < 0.5 else 'sell', rng.randint(1, 100), mid + rng.randint(-spread, spread))
+            for _ in range(orders)]
+    book = OrderBook()
+    submit = book.submit
+    clock = time.perf_counter_ns
+    latencies = [0] * orders
+    fills = 0
+    start = time.perf_counter()
+    for i, (side, quantity, price) in enumerate(feed):
+        began = clock()
+        fills += len(submit(side, quantity, price)[1])
+        latencies[i] = clock() - began
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f'order book: {orders / elapsed:.0f} orders/s, {fills} fills, '
+          f'p50 {latencies[orders // 2] / 1e3:.2f} us, p99 {latencies[int(orders * 0.99)] / 1e3:.2f} us, '
+          f'p99.9 {latencies[int(orders * 0.999)] / 1e3:.2f} us')
 
 
 if __name__ == '__main__':
@@ -79,3 +892,27 @@ if __name__ == '__main__':
     broker.take_order(buy_stock)
     broker.take_order(sell_stock)
     broker.place_orders()
+    broker.close()
+
+    with Broker(coalesce=True) as broker:
+        for quantity in (30, 10, 5):
+            broker.take_order(BuyStock(abc_stock, quantity))
+            broker.take_order(SellStock(abc_stock, quantity * 2))
+        broker.place_orders()
+        print(broker.stats)
+
+    abc_stock.sell(10, 101)
+    abc_stock.sell(5, 100)
+    bid = BuyStock(abc_stock, 12, 101)
+    bid.execute()
+    print(bid.fills, abc_stock.book.depth('sell'))
+
+    with Broker(history=10) as broker:
+        for quantity in (1, 2, 3):
+            broker.take_order(BuyStock(abc_stock, quantity))
+            broker.place_orders()
+        broker.take_order(SellStock(Stock('XYZ'), 4))
+        broker.place_orders()
+        print(f'history: {len(broker.history)}')
+        broker.undo(2)
+        broker.redo()
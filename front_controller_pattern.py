@@ -14,39 +14,242 @@
 FrontControllerPatternDemo，我们的演示类使用 FrontController 来演示前端控制器设计模式。
 """
 import abc
+import asyncio
+import collections
+import hashlib
+import random
+import re
+import sys
+import threading
+import time
+import typing
+from concurrent.futures import Future
 
 
 class View(metaclass=abc.ABCMeta):
+    # 视图输出变化时递增，旧的缓存随之失效
+    version = 1
+
     @abc.abstractmethod
     def show(self):
         """展示"""
 
+    @abc.abstractmethod
+    def render(self, **params) -> str:
+        """渲染为字符串，缓存和异步控制器只使用 render 的结果"""
+
 
 class HomeView(View):
     def show(self):
-        print("Displaying Home Page")
+        print(self.render(), end='')
+
+    def render(self) -> str:
+        return "Displaying Home Page\n"
 
 
 class StudentView(View):
-    def show(self):
-        print("Displaying Student Page")
+    def show(self, id: str = None):
+        print(self.render(id), end='')
+
+    def render(self, id: str = None) -> str:
+        if id is None:
+            return "Displaying Student Page\n"
+        return f"Displaying Student Page: {id}\n"
+
+
+class _RouteNode(object):
+    __slots__ = ('children', 'param', 'param_child', 'view', 'wildcard')
+
+    def __init__(self):
+        self.children: typing.Dict[str, '_RouteNode'] = {}
+        self.param: typing.Optional[str] = None
+        self.param_child: typing.Optional['_RouteNode'] = None
+        self.view: typing.Optional[View] = None
+        self.wildcard: typing.Optional[View] = None
+
+
+class Router(object):
+    """
+    路由表：不含参数的路径放在字典中精确匹配；含参数（<name>）或前缀（结尾为 *）的路径按段放在前缀树中。
+    查找只与请求的路径段数有关，与路由数量无关。同一位置字面量优先于参数，参数优先于前缀。
+    """
+
+    def __init__(self):
+        self._exact: typing.Dict[str, View] = {}
+        self._root = _RouteNode()
+
+    @staticmethod
+    def _split(path: str) -> typing.List[str]:
+        path = path.strip('/')
+        return path.split('/') if path else []
+
+    def add(self, pattern: str, view: View):
+        """注册路由，如 'student'、'student/<id>'、'static/*'"""
+        segments = self._split(pattern)
+        if not any(segment.startswith('<') or segment == '*' for segment in segments):
+            self._exact['/'.join(segments)] = view
+            return
+        node = self._root
+        for i, segment in enumerate(segments):
+            if segment == '*':
+                if i != len(segments) - 1:
+                    raise ValueError(f'wildcard must be the last segment: {pattern}')
+                node.wildcard = view
+                return
+            if segment.startswith('<') and segment.endswith('>'):
+                name = segment[1:-1]
+                if node.param_child is None:
+                    node.param, node.param_child = name, _RouteNode()
+                elif node.param != name:
+                    raise ValueError(f'conflicting parameter <{name}> and <{node.param}>: {pattern}')
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, _RouteNode())
+        node.view = view
+
+    def match(self, path: str) -> typing.Optional[typing.Tuple[View, typing.Dict[str, str]]]:
+        """匹配路径，返回 (视图, 参数)，未匹配时返回 None"""
+        segments = self._split(path)
+        view = self._exact.get('/'.join(segments))
+        if view is not None:
+            return view, {}
+        params: typing.Dict[str, str] = {}
+        view = self._walk(self._root, segments, 0, params)
+        return (view, params) if view is not None else None
+
+    def _walk(self, node: _RouteNode, segments: typing.List[str], i: int,
+              params: typing.Dict[str, str]) -> typing.Optional[View]:
+        if i == len(segments):
+            if node.view is None and node.wildcard is not None:
+                params['path'] = ''
+                return node.wildcard
+            return node.view
+        child = node.children.get(segments[i])
+        if child is not None:
+            view = self._walk(child, segments, i + 1, params)
+            if view is not None:
+                return view
+        if node.param_child is not None:
+            view = self._walk(node.param_child, segments, i + 1, params)
+            if view is not None:
+                params[node.param] = segments[i]
+                return view
+        if node.wildcard is not None:
+            params['path'] = '/'.join(segments[i:])
+            return node.wildcard
+        return None
 
 
 class Dispatcher(object):
     def __init__(self):
         self.student_view = StudentView()
         self.home_view = HomeView()
+        self.router = Router()
+        self.router.add('home', self.home_view)
+        self.router.add('student', self.student_view)
+        self.router.add('student/<id>', self.student_view)
+
+    def register(self, pattern: str, view: View):
+        """注册路由"""
+        self.router.add(pattern, view)
 
-    def dispatch(self, request: str):
-        if request == "student":
-            self.student_view.show()
+    def resolve(self, request: str) -> typing.Optional[typing.Tuple[View, typing.Dict[str, str]]]:
+        """查找请求对应的视图和参数，未知路由返回 None"""
+        return self.router.match(request)
+
+    def dispatch(self, request: str) -> bool:
+        match = self.resolve(request)
+        if match is None:
+            print(f"Page not found: {request}")
+            return False
+        view, params = match
+        if params:
+            view.show(**params)
         else:
-            self.home_view.show()
+            view.show()
+        return True
+
+
+class Response(object):
+    def __init__(self, body: typing.Optional[str], etag: str, status: int = 200):
+        self.body = body
+        self.etag = etag
+        self.status = status
+
+    def __repr__(self):
+        return f'Response(status={self.status}, etag={self.etag})'
+
+
+class ResponseCache(object):
+    """
+    渲染结果的 LRU 缓存，键为 (请求, 视图, 视图版本)。同一键的并发未命中只渲染一次，其余请求等待同一结果。
+    失效时进行中的渲染也被作废：其结果只交给已在等待的请求，不写入缓存。
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._responses: typing.Dict[tuple, Response] = collections.OrderedDict()
+        self._rendering: typing.Dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, render: typing.Callable[[], str]) -> Response:
+        """获取缓存的响应，未命中时调用 render"""
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                self._responses.move_to_end(key)
+                self.hits += 1
+                return response
+            self.misses += 1
+            future = self._rendering.get(key)
+            rendering = future is None
+            if rendering:
+                future = self._rendering[key] = Future()
+        if not rendering:
+            return future.result()
+        try:
+            body = render()
+        except BaseException as e:
+            with self._lock:
+                if self._rendering.get(key) is future:
+                    del self._rendering[key]
+            future.set_exception(e)
+            raise
+        response = Response(body, hashlib.sha1(body.encode()).hexdigest()[:16])
+        with self._lock:
+            # 渲染期间被 invalidate 时 future 已不在 _rendering 中
+            if self._rendering.get(key) is future:
+                del self._rendering[key]
+                self._responses[key] = response
+                if len(self._responses) > self.maxsize:
+                    self._responses.popitem(last=False)
+        future.set_result(response)
+        return response
+
+    def invalidate(self, request: str = None):
+        """移除某个请求的缓存，不指定请求时清空"""
+        with self._lock:
+            if request is None:
+                self._responses.clear()
+                self._rendering.clear()
+                return
+            for key in [key for key in self._responses if key[0] == request]:
+                del self._responses[key]
+            for key in [key for key in self._rendering if key[0] == request]:
+                del self._rendering[key]
 
 
 class FrontController(object):
-    def __init__(self):
+    """
+    提供 cache 时渲染结果被缓存，dispatch_request 返回带 ETag 的 Response；
+    if_none_match 与当前 ETag 相同时返回 304 且不输出页面。
+    """
+
+    def __init__(self, cache: ResponseCache = None):
         self.dispatcher = Dispatcher()
+        self.cache = cache
 
     @staticmethod
     def is_authentic_user():
@@ -57,13 +260,278 @@ class FrontController(object):
     def track_request(request):
         print(f"Page requested: {request}")
 
-    def dispatch_request(self, request):
+    def dispatch_request(self, request, if_none_match: str = None) -> typing.Optional[Response]:
         self.track_request(request)
-        if self.is_authentic_user():
+        if not self.is_authentic_user():
+            return None
+        if self.cache is None:
             self.dispatcher.dispatch(request)
+            return None
+        match = self.dispatcher.resolve(request)
+        if match is None:
+            # 未知路由不缓存，避免随机路径挤占缓存
+            print(f"Page not found: {request}")
+            return Response(None, '', 404)
+        view, params = match
+        response = self.cache.get((request, id(view), view.version), lambda: view.render(**params))
+        if if_none_match is not None and if_none_match == response.etag:
+            return Response(None, response.etag, 304)
+        print(response.body, end='')
+        return response
+
+    def invalidate(self, request: str = None):
+        """使某个请求（不指定时为全部）的缓存失效"""
+        if self.cache is not None:
+            self.cache.invalidate(request)
+
+    @staticmethod
+    def invalidate_view(view: View):
+        """视图输出已变化，使其所有缓存失效"""
+        view.version += 1
+
+
+class TTLCache(object):
+    """按写入时间过期、超出 maxsize 时按插入顺序淘汰的缓存"""
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items: typing.Dict[typing.Hashable, typing.Tuple[float, typing.Any]] = collections.OrderedDict()
+
+    def get(self, key: typing.Hashable, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self._items[key]
+            return default
+        return item[1]
+
+    def set(self, key: typing.Hashable, value):
+        items = self._items
+        items.pop(key, None)
+        items[key] = (time.monotonic() + self.ttl, value)
+        if len(items) > self.maxsize:
+            items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class AsyncFrontController(object):
+    """
+    asyncio 版前端控制器：认证结果按凭证缓存 auth_ttl 秒，最多 auth_maxsize 条，同一凭证的并发认证只执行一次；
+    请求跟踪先写入缓冲区，由后台任务每 track_interval 秒批量写出，不占用响应路径。
+    """
+
+    def __init__(self, cache: ResponseCache = None, auth_ttl: float = 60.0, auth_latency: float = 0.001,
+                 track_interval: float = 0.1, tracker: typing.Callable[[typing.List[str]], None] = None,
+                 auth_maxsize: int = 10000):
+        self.dispatcher = Dispatcher()
+        self.cache = cache if cache is not None else ResponseCache()
+        self.auth_ttl = auth_ttl
+        self.auth_latency = auth_latency
+        self.track_interval = track_interval
+        self.tracker = tracker if tracker is not None else self._write_tracked
+        # 过期的认证结果按插入顺序被挤出，凭证再多也最多保留 auth_maxsize 条
+        self._auth = TTLCache(auth_ttl, auth_maxsize)
+        self._authenticating: typing.Dict[str, asyncio.Future] = {}
+        self._tracked: typing.List[str] = []
+        self._flusher: typing.Optional[asyncio.Future] = None
+
+    async def start(self) -> 'AsyncFrontController':
+        self._flusher = asyncio.ensure_future(self._flush_periodically())
+        return self
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        self._flush()
+
+    async def check_user(self, token: str) -> bool:
+        """访问认证服务，演示中所有用户都能通过认证"""
+        await asyncio.sleep(self.auth_latency)
+        return True
+
+    async def is_authentic_user(self, token: str = '') -> bool:
+        cached = self._auth.get(token)
+        if cached is not None:
+            return cached
+        task = self._authenticating.get(token)
+        if task is None:
+            # 认证在独立的任务中执行，发起它的请求被取消也不影响其他等待者
+            task = self._authenticating[token] = asyncio.ensure_future(self.check_user(token))
+            task.add_done_callback(lambda task: self._authenticated(token, task))
+        return await asyncio.shield(task)
+
+    def _authenticated(self, token: str, task: asyncio.Future):
+        del self._authenticating[token]
+        # 读取异常，没有等待者时也不会出现 "exception never retrieved" 警告
+        if not task.cancelled() and task.exception() is None:
+            self._auth.set(token, task.result())
+
+    def track_request(self, request: str):
+        self._tracked.append(request)
+
+    @staticmethod
+    def _write_tracked(requests: typing.List[str]):
+        sys.stdout.write(''.join(f"Page requested: {request}\n" for request in requests))
+
+    def _flush(self):
+        if self._tracked:
+            tracked, self._tracked = self._tracked, []
+            self.tracker(tracked)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.track_interval)
+            self._flush()
+
+    async def dispatch_request(self, request: str, token: str = '', if_none_match: str = None) -> Response:
+        self.track_request(request)
+        if not await self.is_authentic_user(token):
+            return Response(None, '', 401)
+        match = self.dispatcher.resolve(request)
+        if match is None:
+            # 未知路由不缓存，避免随机路径挤占缓存
+            return Response(None, '', 404)
+        view, params = match
+        response = self.cache.get((request, id(view), view.version), lambda: view.render(**params))
+        if if_none_match is not None and if_none_match == response.etag:
+            return Response(None, response.etag, 304)
+        return response
+
+
+def asgi_app(controller: AsyncFrontController) -> typing.Callable:
+    """把 AsyncFrontController 包装为 ASGI 应用，Authorization 头作为凭证"""
+
+    async def app(scope: dict, receive: typing.Callable, send: typing.Callable):
+        if scope['type'] != 'http':
+            return
+        headers = dict(scope.get('headers') or [])
+        token = headers.get(b'authorization', b'').decode()
+        etag = headers.get(b'if-none-match')
+        response = await controller.dispatch_request(scope['path'], token, etag.decode() if etag else None)
+        body = (response.body or '').encode()
+        response_headers = [(b'content-type', b'text/plain; charset=utf-8'),
+                            (b'content-length', str(len(body)).encode())]
+        if response.etag:
+            response_headers.append((b'etag', response.etag.encode()))
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': response_headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    return app
+
+
+class WSGIAdapter(object):
+    """把 AsyncFrontController 包装为 WSGI 应用，控制器运行在后台线程的事件循环中"""
+    reasons = {200: 'OK', 304: 'Not Modified', 401: 'Unauthorized', 404: 'Not Found'}
+
+    def __init__(self, controller: AsyncFrontController):
+        self.controller = controller
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(controller.start(), self.loop).result()
+
+    def __call__(self, environ: dict, start_response: typing.Callable) -> typing.List[bytes]:
+        coroutine = self.controller.dispatch_request(
+            environ.get('PATH_INFO', ''), environ.get('HTTP_AUTHORIZATION', ''), environ.get('HTTP_IF_NONE_MATCH'))
+        response = asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        body = (response.body or '').encode()
+        headers = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))]
+        if response.etag:
+            headers.append(('ETag', response.etag))
+        start_response(f'{response.status} {self.reasons.get(response.status, "")}', headers)
+        return [body]
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.controller.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+def load_test(requests: int = 50000, concurrency: int = 100, users: int = 100,
+              paths: typing.Sequence[str] = ('home', 'student', 'student/42')):
+    """本地压测：并发客户端直接调用 ASGI 应用，报告 requests/s"""
+
+    async def run():
+        tracked = [0]
+        controller = await AsyncFrontController(tracker=lambda batch: tracked.__setitem__(0, tracked[0] + len(batch)),
+                                                track_interval=0.01).start()
+        app = asgi_app(controller)
+        statuses = collections.Counter()
+
+        async def client(n: int):
+            for i in range(n):
+                scope = {'type': 'http', 'path': paths[i % len(paths)],
+                         'headers': [(b'authorization', f'user{i % users}'.encode())]}
+
+                async def send(message: dict):
+                    if message['type'] == 'http.response.start':
+                        statuses[message['status']] += 1
+
+                await app(scope, None, send)
+
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        await asyncio.gather(*[client(requests // concurrency + (i < requests % concurrency))
+                               for i in range(concurrency)])
+        elapsed = loop.time() - start
+        await controller.close()
+        print(f'load test: {requests / elapsed:.0f} requests/s, statuses {dict(statuses)}, '
+              f'tracked {tracked[0]}, cache hits {controller.cache.hits}')
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def benchmark(routes: int = 10000, requests: int = 20000):
+    """对比路由表与逐条正则匹配在 routes 条路由下的查找耗时"""
+    view = HomeView()
+    router = Router()
+    linear: typing.List[typing.Tuple[typing.Pattern, View]] = []
+    for i in range(routes):
+        pattern = f'api/resource{i}/<id>' if i % 2 else f'page{i}'
+        router.add(pattern, view)
+        linear.append((re.compile('^' + re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', pattern) + '$'), view))
+    rng = random.Random(0)
+    paths = [f'api/resource{i}/42' if i % 2 else f'page{i}' for i in (rng.randrange(routes) for _ in range(requests))]
+
+    def linear_match(path: str):
+        for regex, matched in linear:
+            m = regex.match(path)
+            if m:
+                return matched, m.groupdict()
+        return None
+
+    for name, match, count in (('router', router.match, requests), ('linear', linear_match, requests // 100)):
+        start = time.perf_counter()
+        for path in paths[:count]:
+            match(path)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {elapsed / count * 1e6:.2f} us/lookup with {routes} routes')
 
 
 if __name__ == '__main__':
     front_controller = FrontController()
     front_controller.dispatch_request('home')
     front_controller.dispatch_request('student')
+    front_controller.dispatch_request('student/42')
+    print()
+
+    cached_controller = FrontController(ResponseCache())
+    home = cached_controller.dispatch_request('home')
+    print(cached_controller.dispatch_request('home', if_none_match=home.etag))
+    cached_controller.invalidate_view(cached_controller.dispatcher.home_view)
+    cached_controller.dispatch_request('home')
+    print(f'cache hits: {cached_controller.cache.hits}, misses: {cached_controller.cache.misses}')
@@ -16,19 +16,96 @@ Target - Target 对象是请求处理程序。
 InterceptingFilterDemo，我们的演示类使用 Client 来演示拦截过滤器设计模式。
 """
 import abc
+import asyncio
+import collections
+import time
 import typing
 
+# 过滤器返回 STOP 时拦截请求，专用哨兵对象不会与 True/False 等普通返回值混淆
+STOP = object()
+_MISSING = object()
+
+
+class BaseFilter(object):
+    """
+    过滤器的适用条件与结果缓存：
+    applies 是廉价的前置判断，返回 False 时跳过该过滤器；
+    cache_key 返回非 None 的键时，相同键在 cache_ttl 秒内直接复用上次的结果。
+    """
+    cache_ttl = 60.0
+
+    def applies(self, request: str) -> bool:
+        """是否需要执行该过滤器"""
+        return True
+
+    def cache_key(self, request: str) -> typing.Hashable:
+        """结果缓存的键，None 表示不缓存"""
+        return None
+
+
+class Filter(BaseFilter, metaclass=abc.ABCMeta):
+    """
+    execute 返回 None 表示请求原样传给下一个过滤器；返回 STOP 表示拦截请求，后续过滤器和 Target 都不再执行；
+    返回其他值表示用该值改写请求。
+    """
 
-class Filter(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def execute(self, request: str):
         """执行"""
 
 
+class TTLCache(object):
+    """按写入时间过期、按插入顺序淘汰的缓存"""
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items: typing.Dict[typing.Hashable, typing.Tuple[float, typing.Any]] = collections.OrderedDict()
+
+    def get(self, key: typing.Hashable, default=None):
+        item = self._items.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self.hits += 1
+            return item[1]
+        self.misses += 1
+        return default
+
+    def set(self, key: typing.Hashable, value):
+        items = self._items
+        items.pop(key, None)
+        items[key] = (time.monotonic() + self.ttl, value)
+        if len(items) > self.maxsize:
+            items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+class _Step(object):
+    """链中的一个过滤器及其适用条件和缓存，未覆盖的 applies/cache_key 为 None"""
+    __slots__ = ('execute', 'is_async', 'applies', 'cache_key', 'cache')
+
+    def __init__(self, f: BaseFilter, execute: typing.Callable = None):
+        self.execute = execute or f.execute
+        self.is_async = asyncio.iscoroutinefunction(f.execute)
+        self.applies = f.applies if type(f).applies is not BaseFilter.applies else None
+        has_key = type(f).cache_key is not BaseFilter.cache_key
+        self.cache_key = f.cache_key if has_key else None
+        self.cache = TTLCache(f.cache_ttl) if has_key else None
+
+
 class AuthenticationFilter(Filter):
+    cache_ttl = 30.0
+
     def execute(self, request: str):
         print(f"Authenticating request: {request}")
 
+    def cache_key(self, request: str) -> typing.Hashable:
+        # 演示中请求本身即凭证，同一凭证在有效期内只认证一次
+        return request
+
 
 class DebugFilter(Filter):
     def execute(self, request: str):
@@ -41,32 +118,142 @@ class Target(object):
         print(f"Executing request: {request}")
 
 
+class FilterTiming(object):
+    """单个过滤器的累计耗时"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+
+    def wrap(self, execute: typing.Callable[[str], typing.Any]) -> typing.Callable[[str], typing.Any]:
+        clock = time.perf_counter
+
+        def timed(request: str):
+            start = clock()
+            try:
+                return execute(request)
+            finally:
+                self.seconds += clock() - start
+                self.calls += 1
+
+        return timed
+
+    def __repr__(self):
+        return f'FilterTiming({self.name}, calls={self.calls}, seconds={self.seconds:.6f})'
+
+
 class FilterChain(object):
-    filters: typing.List[Filter] = []
-    target = None
+    """
+    freeze 后过滤器链被编译为一个函数：各过滤器的 execute 作为局部变量直接调用，省去逐个过滤器的循环和属性查找。
+    timing 为 True 时编译后的链记录每个过滤器的耗时，见 timings。
+    """
+
+    def __init__(self, timing: bool = False):
+        self.filters: typing.List[Filter] = []
+        self.target = None
+        self.timing = timing
+        self.timings: typing.List[FilterTiming] = []
+        self._steps: typing.Optional[typing.List[_Step]] = None
+        self._compiled: typing.Optional[typing.Callable[[str], typing.Any]] = None
 
     def add_filter(self, filters: Filter):
+        if self._compiled is not None:
+            raise RuntimeError('filter chain is frozen')
         self.filters.append(filters)
+        self._steps = None
+
+    def freeze(self) -> typing.Callable[[str], typing.Any]:
+        """编译过滤器链，之后不能再添加过滤器"""
+        if self._compiled is None:
+            self._compiled = self._compile()
+        return self._compiled
+
+    def _compile(self) -> typing.Callable[[str], typing.Any]:
+        namespace = {'STOP': STOP, 'MISSING': _MISSING, 'target': self.target.execute}
+        lines = ['def chain(request):']
+        self.timings = [FilterTiming(type(f).__name__) for f in self.filters] if self.timing else []
+        for i, f in enumerate(self.filters):
+            step = _Step(f, self.timings[i].wrap(f.execute) if self.timing else None)
+            namespace[f'f{i}'] = step.execute
+            if step.cache is None:
+                body = [f'r = f{i}(request)']
+            else:
+                namespace[f'k{i}'], namespace[f'c{i}'] = step.cache_key, step.cache
+                body = [
+                    f'k = k{i}(request)',
+                    f'r = c{i}.get(k, MISSING) if k is not None else MISSING',
+                    f'if r is MISSING:',
+                    f'    r = f{i}(request)',
+                    f'    if k is not None:',
+                    f'        c{i}.set(k, r)',
+                ]
+            body += [
+                f'if r is not None:',
+                f'    if r is STOP:',
+                f'        return None',
+                f'    request = r',
+            ]
+            indent = '    '
+            if step.applies is not None:
+                namespace[f'p{i}'] = step.applies
+                lines.append(f'    if p{i}(request):')
+                indent = '        '
+            lines += [indent + line for line in body]
+        lines.append('    return target(request)')
+        exec('\n'.join(lines), namespace)
+        return namespace['chain']
 
     def execute(self, request: str):
-        for f in self.filters:
-            f.execute(request)
-        self.target.execute(request)
+        if self._compiled is not None:
+            return self._compiled(request)
+        if self._steps is None:
+            self._steps = [_Step(f) for f in self.filters]
+        for step in self._steps:
+            if step.applies is not None and not step.applies(request):
+                continue
+            if step.cache is None:
+                r = step.execute(request)
+            else:
+                r = self._cached(step, request)
+            if r is not None:
+                if r is STOP:
+                    return None
+                request = r
+        return self.target.execute(request)
+
+    @staticmethod
+    def _cached(step: _Step, request: str):
+        key = step.cache_key(request)
+        if key is None:
+            return step.execute(request)
+        r = step.cache.get(key, _MISSING)
+        if r is _MISSING:
+            r = step.execute(request)
+            step.cache.set(key, r)
+        return r
 
     def set_target(self, target: Target):
         self.target = target
+        if self._compiled is not None:
+            # 已冻结的链保持冻结，按新的 Target 重新编译
+            self._compiled = self._compile()
 
 
 class FilterManager(object):
-    def __init__(self, target: Target):
-        self.filter_chain = FilterChain()
+    def __init__(self, target: Target, timing: bool = False):
+        self.filter_chain = FilterChain(timing)
         self.filter_chain.set_target(target)
 
     def set_filter(self, filters: Filter):
         self.filter_chain.add_filter(filters)
 
+    def freeze(self):
+        """编译过滤器链"""
+        self.filter_chain.freeze()
+
     def filter_request(self, request: str):
-        self.filter_chain.execute(request)
+        return self.filter_chain.execute(request)
 
 
 class Client(object):
@@ -76,7 +263,173 @@ class Client(object):
         self.filter_manager = filter_manager
 
     def send_request(self, request: str):
-        self.filter_manager.filter_request(request)
+        return self.filter_manager.filter_request(request)
+
+
+class AsyncFilter(BaseFilter, metaclass=abc.ABCMeta):
+    """异步过滤器，返回值与适用条件、缓存的约定与 Filter 相同"""
+
+    @abc.abstractmethod
+    async def execute(self, request: str):
+        """执行"""
+
+
+class AsyncAuthenticationFilter(AsyncFilter):
+    def __init__(self, latency: float = 0.001):
+        self.latency = latency
+
+    async def execute(self, request: str):
+        # 模拟访问认证服务的 I/O
+        await asyncio.sleep(self.latency)
+
+    def cache_key(self, request: str) -> typing.Hashable:
+        return request
+
+
+class AsyncTarget(object):
+    @staticmethod
+    async def execute(request: str):
+        return request
+
+
+class AsyncFilterChain(object):
+    """
+    异步过滤器链，同步的 Filter 也可以加入，直接调用而不 await。
+    带缓存的异步过滤器对同一缓存键的并发请求只执行一次，其余请求等待同一个任务。
+    """
+
+    def __init__(self):
+        self.filters: typing.List[typing.Union[AsyncFilter, Filter]] = []
+        self.target = None
+        self._steps: typing.List[_Step] = []
+        self._inflight: typing.Dict[typing.Tuple[int, typing.Hashable], asyncio.Future] = {}
+
+    def add_filter(self, filters: typing.Union[AsyncFilter, Filter]):
+        self.filters.append(filters)
+        self._steps.append(_Step(filters))
+
+    async def execute(self, request: str):
+        for index, step in enumerate(self._steps):
+            if step.applies is not None and not step.applies(request):
+                continue
+            key = step.cache_key(request) if step.cache is not None else None
+            r = step.cache.get(key, _MISSING) if key is not None else _MISSING
+            if r is _MISSING:
+                if not step.is_async:
+                    r = step.execute(request)
+                    if key is not None:
+                        step.cache.set(key, r)
+                elif key is None:
+                    r = await step.execute(request)
+                else:
+                    r = await self._single_flight(index, step, key, request)
+            if r is not None:
+                if r is STOP:
+                    return None
+                request = r
+        return await self.target.execute(request)
+
+    async def _single_flight(self, index: int, step: _Step, key: typing.Hashable, request: str):
+        """同一过滤器、同一缓存键只保留一个执行中的任务，结果在任务完成时写入缓存"""
+        task = self._inflight.get((index, key))
+        if task is None:
+            task = self._inflight[(index, key)] = asyncio.ensure_future(step.execute(request))
+
+            def done(task: asyncio.Future):
+                del self._inflight[(index, key)]
+                # 读取异常，所有等待者都被取消时也不会出现 "exception never retrieved" 警告
+                if not task.cancelled() and task.exception() is None:
+                    step.cache.set(key, task.result())
+
+            task.add_done_callback(done)
+        # 单个请求被取消不影响共享的任务
+        return await asyncio.shield(task)
+
+    def set_target(self, target: AsyncTarget):
+        self.target = target
+
+
+class AsyncFilterManager(object):
+    """异步过滤管理器，同时处理的请求数不超过 concurrency"""
+
+    def __init__(self, target: AsyncTarget, concurrency: int = 1000):
+        self.filter_chain = AsyncFilterChain()
+        self.filter_chain.set_target(target)
+        self.concurrency = concurrency
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+
+    def set_filter(self, filters: typing.Union[AsyncFilter, Filter]):
+        self.filter_chain.add_filter(filters)
+
+    async def filter_request(self, request: str):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            return await self.filter_chain.execute(request)
+
+    async def filter_requests(self, requests: typing.Iterable[str]) -> list:
+        """并发处理一批请求"""
+        return await asyncio.gather(*[self.filter_request(request) for request in requests])
+
+
+def benchmark(filters: int = 20, requests: int = 200000):
+    """对比解释执行与编译后的过滤器链，每个请求经过 filters 个过滤器"""
+
+    class PassFilter(Filter):
+        def execute(self, request: str):
+            pass
+
+    class NullTarget(Target):
+        @staticmethod
+        def execute(request: str):
+            return request
+
+    for frozen in (False, True):
+        chain = FilterChain()
+        chain.set_target(NullTarget())
+        for _ in range(filters):
+            chain.add_filter(PassFilter())
+        if frozen:
+            chain.freeze()
+        execute = chain.execute
+        start = time.perf_counter()
+        for _ in range(requests):
+            execute('HOME')
+        elapsed = time.perf_counter() - start
+        print(f'{"compiled" if frozen else "dynamic":>8} chain of {filters} filters: '
+              f'{elapsed / requests * 1e6:.2f} us/request')
+
+
+def benchmark_async(requests: int = 20000, concurrency: int = 1000, latency: float = 0.001):
+    """异步过滤管理器压测，报告吞吐量与 p50/p99 延迟"""
+
+    async def run():
+        manager = AsyncFilterManager(AsyncTarget(), concurrency)
+        manager.set_filter(AsyncAuthenticationFilter(latency))
+        loop = asyncio.get_event_loop()
+        latencies = []
+
+        async def client(count: int):
+            # 闭环负载：每个客户端收到回复后再发下一个请求
+            for i in range(count):
+                began = loop.time()
+                await manager.filter_request(f'REQUEST {i}')
+                latencies.append(loop.time() - began)
+
+        start = loop.time()
+        await asyncio.gather(*[client(requests // concurrency + (i < requests % concurrency))
+                               for i in range(concurrency)])
+        elapsed = loop.time() - start
+        latencies.sort()
+        print(f'async filters: {requests / elapsed:.0f} requests/s, '
+              f'p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms')
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
 
 
 if __name__ == '__main__':
@@ -87,3 +440,8 @@ if __name__ == '__main__':
     client = Client()
     client.set_filter_manager(manager)
     client.send_request('HOME')
+    print()
+
+    manager.freeze()
+    client.send_request('STUDENT')
+    client.send_request('STUDENT')
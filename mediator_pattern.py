@@ -22,18 +22,627 @@
 我们通过聊天室实例来演示中介者模式。实例中，多个用户可以向聊天室发送消息，聊天室向所有的用户显示消息。我们将创建两个类 ChatRoom 和 User。User 对象使用 ChatRoom 方法来分享他们的消息。
 MediatorPatternDemo，我们的演示类使用 User 对象来显示他们之间的通信。
 """
+import array
+import asyncio
+import atexit
+import bisect
+import contextlib
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import threading
 import time
+import typing
+import weakref
+
+
+class SecondClock(object):
+    """按秒缓存格式化后的时间，同一秒内不再重复调用 strftime"""
+
+    def __init__(self, fmt: str = '%Y-%m-%d %H:%M:%S'):
+        self.fmt = fmt
+        # (秒, 文本) 作为整体替换，多线程读取时不会错配
+        self._cached: typing.Tuple[int, str] = (-1, '')
+
+    def now(self) -> str:
+        second = int(time.time())
+        cached = self._cached
+        if cached[0] != second:
+            cached = self._cached = (second, time.strftime(self.fmt, time.localtime(second)))
+        return cached[1]
+
+
+class BufferedSink(object):
+    """
+    行缓冲输出：攒够 batch_size 行或距第一行缓冲超过 interval 秒时一次写出，退出时写出剩余内容。
+    超时写出由每个实例唯一的后台线程每隔 interval 秒检查一次，写入路径上不创建也不唤醒线程。
+    """
+    _sinks: 'weakref.WeakSet[BufferedSink]' = weakref.WeakSet()
+
+    def __init__(self, stream: typing.TextIO = None, batch_size: int = 1024, interval: float = 0.05):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lines: typing.List[str] = []
+        self._lock = threading.Lock()
+        self._flusher: typing.Optional[threading.Thread] = None
+        BufferedSink._sinks.add(self)
+
+    def write(self, line: str):
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) >= self.batch_size:
+                self._flush()
+            elif self._flusher is None:
+                self._flusher = threading.Thread(target=BufferedSink._run, args=(weakref.ref(self), self.interval),
+                                                 daemon=True)
+                self._flusher.start()
+
+    @staticmethod
+    def _run(ref: 'weakref.ref[BufferedSink]', interval: float):
+        # 只持有弱引用，实例被回收后线程退出
+        while True:
+            time.sleep(interval)
+            sink = ref()
+            if sink is None:
+                return
+            sink.flush()
+            del sink
+
+    def _flush(self):
+        if self._lines:
+            lines, self._lines = self._lines, []
+            # 默认在写出时才取 sys.stdout，以便被重定向
+            stream = self.stream if self.stream is not None else sys.stdout
+            stream.write(''.join(lines))
+            stream.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    @classmethod
+    def flush_all(cls):
+        for sink in list(cls._sinks):
+            sink.flush()
+
+
+atexit.register(BufferedSink.flush_all)
+
+
+class Message(object):
+    __slots__ = ('time', 'user', 'text', 'room', 'offset')
+
+    def __init__(self, user: str, text: str, room: str, timestamp: float = None, offset: int = None):
+        self.time = time.time() if timestamp is None else timestamp
+        self.user = user
+        self.text = text
+        self.room = room
+        # 在房间历史中的序号，未持久化时为 None
+        self.offset = offset
+
+    def __repr__(self):
+        return f'Message({self.room}, {self.user}: {self.text})'
+
+
+class _Segment(object):
+    """
+    日志段：预分配大小的内存映射文件，文件名为段内第一条消息的序号。
+    记录格式为 [总长度 I][时间 d][用户名长度 H][用户名][内容]，总长度为 0 表示尚未写入的区域。
+    """
+    header = struct.Struct('!IdH')
+
+    def __init__(self, path: str, base: int, size: int):
+        self.path = path
+        self.base = base
+        exists = os.path.exists(path)
+        with open(path, 'r+b' if exists else 'w+b') as f:
+            if not exists:
+                f.truncate(size)
+            self.size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), self.size)
+        # 偏移索引：每条记录在段内的起始位置，打开时只跳读记录头重建
+        self.positions = array.array('Q')
+        self.end = 0
+        self.last_time = 0.0
+        while self.end + self.header.size <= self.size:
+            length, timestamp, _ = self.header.unpack_from(self._mmap, self.end)
+            if not length:
+                break
+            self.positions.append(self.end)
+            self.end += length
+            self.last_time = timestamp
+
+    @property
+    def next_offset(self) -> int:
+        return self.base + len(self.positions)
+
+    def append(self, timestamp: float, user: bytes, text: bytes) -> bool:
+        """追加一条记录，空间不足时返回 False"""
+        length = self.header.size + len(user) + len(text)
+        if self.end + length > self.size:
+            return False
+        start = self.end + self.header.size
+        self._mmap[start:start + len(user)] = user
+        self._mmap[start + len(user):self.end + length] = text
+        # 最后写记录头，非零长度即表示记录完整
+        self.header.pack_into(self._mmap, self.end, length, timestamp, len(user))
+        self.positions.append(self.end)
+        self.end += length
+        self.last_time = timestamp
+        return True
+
+    def read(self, offset: int, room: str) -> Message:
+        position = self.positions[offset - self.base]
+        length, timestamp, user_length = self.header.unpack_from(self._mmap, position)
+        start = position + self.header.size
+        user = self._mmap[start:start + user_length].decode()
+        text = self._mmap[start + user_length:position + length].decode()
+        return Message(user, text, room, timestamp, offset)
+
+    def close(self):
+        self._mmap.close()
+
+
+class RoomHistory(object):
+    """
+    单个房间的只追加历史，由若干内存映射日志段组成。
+    按序号读取时二分查找所在段，再用段内偏移索引直接定位，只解码被读取的消息。
+    """
+
+    def __init__(self, directory: str, room: str, segment_bytes: int = 1024 * 1024,
+                 max_age: float = None, max_bytes: int = None):
+        self.directory = directory
+        self.room = room
+        self.segment_bytes = segment_bytes
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        self.segments = [_Segment(self._path(base), base, segment_bytes) for base in bases]
+        if not self.segments:
+            self.segments.append(_Segment(self._path(0), 0, segment_bytes))
+        self._bases = [segment.base for segment in self.segments]
+
+    def _path(self, base: int) -> str:
+        return os.path.join(self.directory, f'{base:020d}.log')
+
+    @property
+    def first_offset(self) -> int:
+        return self.segments[0].base
+
+    @property
+    def next_offset(self) -> int:
+        return self.segments[-1].next_offset
+
+    def append(self, message: Message) -> int:
+        """追加消息，返回其序号"""
+        user, text = message.user.encode(), message.text.encode()
+        with self._lock:
+            segment = self.segments[-1]
+            if not segment.append(message.time, user, text):
+                size = max(self.segment_bytes, _Segment.header.size + len(user) + len(text))
+                if segment.positions:
+                    segment = _Segment(self._path(segment.next_offset), segment.next_offset, size)
+                    self.segments.append(segment)
+                    self._bases.append(segment.base)
+                else:
+                    # 空段放不下超大消息时原地扩大，避免新段与它同名
+                    segment.close()
+                    os.truncate(segment.path, size)
+                    segment = self.segments[-1] = _Segment(segment.path, segment.base, size)
+                if not segment.append(message.time, user, text):
+                    raise ValueError(f'message of {size} bytes does not fit in a new segment')
+                self._retire()
+            elif self.max_age is not None and self.segments[0].last_time < message.time - self.max_age:
+                # 消息少的房间很久才换段，追加时也检查最旧的段是否过期
+                self._retire()
+            message.offset = segment.next_offset - 1
+            return message.offset
+
+    def read(self, offset: int, limit: int = 100) -> typing.List[Message]:
+        """从 offset 开始读取至多 limit 条消息，已淘汰的部分从现存最早的消息开始"""
+        with self._lock:
+            offset = max(offset, self.first_offset)
+            end = min(offset + limit, self.next_offset)
+            messages = []
+            i = bisect.bisect_right(self._bases, offset) - 1
+            while offset < end:
+                segment = self.segments[i]
+                while offset < end and offset < segment.next_offset:
+                    messages.append(segment.read(offset, self.room))
+                    offset += 1
+                i += 1
+            return messages
+
+    def last(self, n: int) -> typing.List[Message]:
+        """读取最近 n 条消息"""
+        return self.read(self.next_offset - n, n)
+
+    def _retire(self):
+        """按时间或总大小淘汰最旧的段，当前写入的段不会被淘汰"""
+        now = time.time()
+        total = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            expired = self.max_age is not None and oldest.last_time < now - self.max_age
+            oversize = self.max_bytes is not None and total > self.max_bytes
+            if not (expired or oversize):
+                break
+            total -= oldest.size
+            oldest.close()
+            os.remove(oldest.path)
+            del self.segments[0]
+            del self._bases[0]
+
+    def retire(self):
+        with self._lock:
+            self._retire()
+
+    def close(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.close()
+
+
+class ChatHistory(object):
+    """按房间管理持久化历史，每个房间一个子目录"""
+
+    def __init__(self, directory: str, **options):
+        self.directory = directory
+        self.options = options
+        self.rooms: typing.Dict[str, RoomHistory] = {}
+
+    def room(self, room: str) -> RoomHistory:
+        history = self.rooms.get(room)
+        if history is None:
+            # 房间名可能含路径分隔符，目录名使用其十六进制编码
+            path = os.path.join(self.directory, room.encode().hex())
+            history = self.rooms[room] = RoomHistory(path, room, **self.options)
+        return history
+
+    def close(self):
+        for history in self.rooms.values():
+            history.close()
+
+
+class SharedRing(object):
+    """
+    基于 multiprocessing.shared_memory 的单生产者/多消费者环形缓冲区，每个消费者都会收到全部消息。
+    共享内存布局：[写序号 Q][注册纪元 Q][各消费者读序号 Q * consumers][槽位...]，每个槽位为 [长度 I][填充][数据]。
+    生产者写完数据后才推进写序号，消费者读完（下一次 read）后才推进自己的读序号，
+    消费者注册时递增注册纪元，生产者据此重新计算可写上限，
+    生产者不会覆盖任何活跃消费者尚未释放的槽位，因此双方都无需加锁。
+    struct.pack_into 不带内存屏障，正确性依赖对齐的 8 字节写入是原子的，且存储之间、加载之间不会重排，
+    即 x86-64 的内存模型；ARM64 等弱内存序平台上不保证消费者先看到数据再看到写序号。
+    需要 Python 3.8 及以上的 multiprocessing.shared_memory。
+    """
+    _word = struct.Struct('Q')
+    _length = struct.Struct('I')
+    # 未注册的消费者
+    IDLE = 2 ** 64 - 1
+
+    def __init__(self, name: str = None, slots: int = 1024, slot_size: int = 1024, consumers: int = 8,
+                 create: bool = True):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.consumers = consumers
+        self.stride = (8 + slot_size + 7) // 8 * 8
+        self.header_size = (8 * (2 + consumers) + 63) // 64 * 64
+        size = self.header_size + self.stride * slots
+        from multiprocessing import shared_memory
+
+        self.shm = shared_memory.SharedMemory(name, create=create, size=size if create else 0)
+        self.buf = self.shm.buf
+        if create:
+            self._word.pack_into(self.buf, 0, 0)
+            self._word.pack_into(self.buf, 8, 0)
+            for index in range(consumers):
+                self._word.pack_into(self.buf, 8 * (2 + index), self.IDLE)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def attach_args(self) -> tuple:
+        """在其他进程中重新打开同一环形缓冲区所需的参数"""
+        return self.name, self.slots, self.slot_size, self.consumers, False
+
+    def write_seq(self) -> int:
+        return self._word.unpack_from(self.buf, 0)[0]
+
+    def epoch(self) -> int:
+        return self._word.unpack_from(self.buf, 8)[0]
+
+    def cursor(self, index: int) -> int:
+        return self._word.unpack_from(self.buf, 8 * (2 + index))[0]
+
+    def set_cursor(self, index: int, seq: int):
+        self._word.pack_into(self.buf, 8 * (2 + index), seq)
+
+    def register(self, index: int, seq: int):
+        """注册消费者：先写读序号再递增注册纪元，生产者下次写入前会重新检查所有读序号"""
+        self.set_cursor(index, seq)
+        self._word.pack_into(self.buf, 8, self.epoch() + 1)
+
+    def slot(self, seq: int) -> int:
+        return self.header_size + self.stride * (seq % self.slots)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def _backoff(spins: int):
+    # 先让出时间片，等待较久后再短暂休眠，避免空转占满 CPU
+    time.sleep(0 if spins < 1000 else 0.0001)
+
+
+class RingProducer(object):
+    def __init__(self, ring: SharedRing):
+        self.ring = ring
+        self.seq = ring.write_seq()
+        # 不必检查消费者即可写入的序号上限，注册纪元变化时重新计算
+        self._limit = self.seq
+        self._epoch = -1
+
+    def _min_cursor(self) -> int:
+        ring = self.ring
+        return min(ring.cursor(index) for index in range(ring.consumers))
+
+    def publish(self, data: bytes, block: bool = True) -> typing.Optional[int]:
+        """写入一条消息，最慢的消费者尚未释放要覆盖的槽位时等待；block 为 False 时不等待，返回 None"""
+        ring = self.ring
+        if len(data) > ring.slot_size:
+            raise ValueError(f'message of {len(data)} bytes exceeds slot size {ring.slot_size}')
+        spins = 0
+        epoch = ring.epoch()
+        while self.seq >= self._limit or epoch != self._epoch:
+            self._epoch = epoch
+            self._limit = self._min_cursor() + ring.slots
+            if self.seq < self._limit:
+                break
+            if not block:
+                return None
+            _backoff(spins)
+            spins += 1
+            epoch = ring.epoch()
+        offset = ring.slot(self.seq)
+        ring._length.pack_into(ring.buf, offset, len(data))
+        ring.buf[offset + 8:offset + 8 + len(data)] = data
+        self.seq += 1
+        ring._word.pack_into(ring.buf, 0, self.seq)
+        return self.seq - 1
+
+
+class RingConsumer(object):
+    """
+    消费者，index 在所有进程间唯一。read 返回直接指向共享内存的 memoryview，
+    该视图在下一次 read 或 close 之前有效。
+    """
+
+    def __init__(self, ring: SharedRing, index: int, start: int = None):
+        self.ring = ring
+        self.index = index
+        self.seq = ring.write_seq() if start is None else start
+        self._view: typing.Optional[memoryview] = None
+        ring.register(index, self.seq)
+        if start is None:
+            # 注册生效前生产者可能已越过该位置，从注册之后的写序号开始读
+            self.seq = ring.write_seq()
+            ring.set_cursor(index, self.seq)
+
+    def _release(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+            self.ring.set_cursor(self.index, self.seq)
+
+    def read(self, timeout: float = None) -> typing.Optional[memoryview]:
+        """读取下一条消息，超时返回 None"""
+        self._release()
+        ring = self.ring
+        deadline = None if timeout is None else time.monotonic() + timeout
+        spins = 0
+        while ring.write_seq() <= self.seq:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            _backoff(spins)
+            spins += 1
+        offset = ring.slot(self.seq)
+        length, = ring._length.unpack_from(ring.buf, offset)
+        self.seq += 1
+        self._view = ring.buf[offset + 8:offset + 8 + length]
+        return self._view
+
+    def close(self):
+        self._release()
+        self.ring.set_cursor(self.index, SharedRing.IDLE)
+
+
+class SharedMemoryTransport(object):
+    """
+    中介者的跨进程传输：ChatRoom 在一个进程中发布，其他进程中的聊天工作者通过各自的消费者接收。
+    消息编码为 [时间 d][用户名长度 H][房间长度 H][用户名][房间][内容]，不经过 pickle。
+    """
+    header = struct.Struct('dHH')
+
+    def __init__(self, ring: SharedRing):
+        self.ring = ring
+        self._producer: typing.Optional[RingProducer] = None
+
+    def send(self, message: Message, block: bool = True) -> typing.Optional[int]:
+        """发送消息，block 为 False 且环形缓冲区已满时返回 None"""
+        if self._producer is None:
+            self._producer = RingProducer(self.ring)
+        user, room = message.user.encode(), message.room.encode()
+        return self._producer.publish(self.header.pack(message.time, len(user), len(room)) + user + room +
+                                      message.text.encode(), block)
+
+    def consumer(self, index: int) -> RingConsumer:
+        return RingConsumer(self.ring, index)
+
+    @classmethod
+    def decode(cls, data: memoryview) -> Message:
+        timestamp, user_length, room_length = cls.header.unpack_from(data)
+        start = cls.header.size
+        user = bytes(data[start:start + user_length]).decode()
+        room = bytes(data[start + user_length:start + user_length + room_length]).decode()
+        text = bytes(data[start + user_length + room_length:]).decode()
+        return Message(user, text, room, timestamp)
+
+    def receive(self, consumer: RingConsumer, timeout: float = None) -> typing.Optional[Message]:
+        data = consumer.read(timeout)
+        return None if data is None else self.decode(data)
+
+
+class Subscription(object):
+    """订阅者在某个房间的有界消息队列"""
+
+    def __init__(self, user: 'User', room: str, maxsize: int):
+        self.user = user
+        self.room = room
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+        self._closing = asyncio.Event()
+
+    async def put(self, message: Message) -> bool:
+        """等待队列有空位后放入消息，等待期间订阅被关闭则放弃并返回 False"""
+        if self.closed:
+            return False
+        put = asyncio.ensure_future(self.queue.put(message))
+        closing = asyncio.ensure_future(self._closing.wait())
+        try:
+            await asyncio.wait((put, closing), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            closing.cancel()
+            if not put.done():
+                put.cancel()
+        return put.done() and not put.cancelled()
+
+    def close(self):
+        self.closed = True
+        self._closing.set()
+        # 唤醒正在等待的接收者；队列已满时接收者取完消息后自然结束
+        if not self.queue.full():
+            self.queue.put_nowait(None)
+
+    async def receive(self) -> typing.Optional[Message]:
+        """接收下一条消息，被断开后返回 None"""
+        if self.closed and self.queue.empty():
+            return None
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Message:
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
 
 
 class ChatRoom(object):
+    """
+    asyncio 消息中心：按房间扇出消息，每个订阅者一个有界队列。
+    队列满时按 policy 处理慢消费者：drop 丢弃该订阅者的这条消息，block 等待队列有空位，disconnect 断开该订阅者。
+    transport 的环形缓冲区已满时不阻塞事件循环：block 策略下让出事件循环后重试，其他策略丢弃并计入 transport_dropped。
+    """
+    DROP = 'drop'
+    BLOCK = 'block'
+    DISCONNECT = 'disconnect'
+    clock = SecondClock()
+    sink = BufferedSink()
+
+    def __init__(self, maxsize: int = 100, policy: str = DROP, history: ChatHistory = None,
+                 transport: SharedMemoryTransport = None):
+        if policy not in (self.DROP, self.BLOCK, self.DISCONNECT):
+            raise ValueError(f'unknown slow consumer policy: {policy}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.history = history
+        self.transport = transport
+        self.rooms: typing.Dict[str, typing.Dict['User', Subscription]] = {}
+        self.published = 0
+        self.delivered = 0
+        self.transport_dropped = 0
+
     @staticmethod
     def show_message(user, message: str):
-        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {user.name}: {message}")
+        ChatRoom.sink.write(f"{ChatRoom.clock.now()} {user.name}: {message}\n")
+
+    def subscribe(self, user: 'User', room: str = 'lobby') -> Subscription:
+        subscribers = self.rooms.setdefault(room, {})
+        subscription = subscribers.get(user)
+        if subscription is None:
+            subscription = subscribers[user] = Subscription(user, room, self.maxsize)
+        return subscription
+
+    def unsubscribe(self, user: 'User', room: str = 'lobby'):
+        subscribers = self.rooms.get(room)
+        if not subscribers:
+            return
+        subscription = subscribers.pop(user, None)
+        if subscription is not None:
+            subscription.close()
+        if not subscribers:
+            del self.rooms[room]
+
+    def recent(self, room: str = 'lobby', last: int = 50, offset: int = None) -> typing.List[Message]:
+        """读取房间历史：最近 last 条，或从 offset 开始（断线重连时传入最后收到的序号 + 1）"""
+        if self.history is None:
+            return []
+        history = self.history.room(room)
+        return history.last(last) if offset is None else history.read(offset, last)
+
+    async def publish(self, user: 'User', text: str, room: str = 'lobby') -> int:
+        """向房间内所有订阅者扇出消息，返回投递成功的数量"""
+        message = Message(user.name, text, room)
+        if self.history is not None:
+            self.history.room(room).append(message)
+        if self.transport is not None:
+            while self.transport.send(message, block=False) is None:
+                if self.policy != self.BLOCK:
+                    self.transport_dropped += 1
+                    break
+                await asyncio.sleep(0.0001)
+        subscribers = self.rooms.get(room)
+        if not subscribers:
+            return 0
+        delivered = 0
+        slow = []
+        for subscription in subscribers.values():
+            try:
+                subscription.queue.put_nowait(message)
+                delivered += 1
+            except asyncio.QueueFull:
+                slow.append(subscription)
+        for subscription in slow:
+            if self.policy == self.BLOCK:
+                # 等待期间订阅者离开时放弃投递，不会永远阻塞
+                if await subscription.put(message):
+                    delivered += 1
+            elif self.policy == self.DISCONNECT:
+                self.unsubscribe(subscription.user, room)
+            else:
+                subscription.dropped += 1
+        self.published += 1
+        self.delivered += delivered
+        return delivered
 
 
 class User(object):
-    def __init__(self, name: str):
+    def __init__(self, name: str, chat_room: ChatRoom = None):
         self._name = name
+        self.chat_room = chat_room
 
     @property
     def name(self):
@@ -46,9 +655,143 @@ class User(object):
     def send_message(self, message: str):
         ChatRoom.show_message(self, message)
 
+    def join(self, room: str = 'lobby') -> Subscription:
+        """订阅房间"""
+        return self.chat_room.subscribe(self, room)
+
+    def leave(self, room: str = 'lobby'):
+        self.chat_room.unsubscribe(self, room)
+
+    async def say(self, message: str, room: str = 'lobby') -> int:
+        """向房间发布消息"""
+        return await self.chat_room.publish(self, message, room)
+
+
+def benchmark(subscribers: int = 10000, messages: int = 100, maxsize: int = 1000):
+    """扇出基准：报告每秒投递的消息数和投递延迟"""
+
+    async def run():
+        chat_room = ChatRoom(maxsize, ChatRoom.BLOCK)
+        sender = User('sender', chat_room)
+        latencies = []
+
+        async def consume(subscription: Subscription):
+            async for message in subscription:
+                latencies.append(time.time() - message.time)
+
+        consumers = [asyncio.ensure_future(consume(User(f'user{i}', chat_room).join()))
+                     for i in range(subscribers)]
+        start = time.perf_counter()
+        for i in range(messages):
+            await sender.say(f'message {i}')
+            # 让出事件循环，使消费者与发布交替运行
+            await asyncio.sleep(0)
+        while len(latencies) < subscribers * messages:
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        for subscription in list(chat_room.rooms['lobby'].values()):
+            chat_room.unsubscribe(subscription.user)
+        await asyncio.gather(*consumers)
+        latencies.sort()
+        print(f'fan-out to {subscribers} subscribers: {len(latencies) / elapsed:.0f} messages/s, '
+              f'p50 {latencies[len(latencies) // 2] * 1e3:.2f} ms, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms')
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def benchmark_show_message(messages: int = 200000):
+    """对比逐条 strftime + print 与缓存时间 + 批量输出"""
+    user = User('bench')
+    with open(os.devnull, 'w') as devnull:
+        # 与原实现一致：逐条 strftime 后 print 到 sys.stdout
+        with contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for i in range(messages):
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {user.name}: message {i}")
+            before = time.perf_counter() - start
+
+        sink, ChatRoom.sink = ChatRoom.sink, BufferedSink(devnull)
+        try:
+            start = time.perf_counter()
+            for i in range(messages):
+                ChatRoom.show_message(user, f'message {i}')
+            ChatRoom.sink.flush()
+            after = time.perf_counter() - start
+        finally:
+            ChatRoom.sink = sink
+    print(f'show_message: {messages / before:.0f} -> {messages / after:.0f} messages/s')
+
+
+def _count_ring(args: tuple, index: int, messages: int, ready):
+    ring = SharedRing(*args)
+    consumer = RingConsumer(ring, index, start=0)
+    ready.set()
+    total = 0
+    for _ in range(messages):
+        total += len(consumer.read())
+    consumer.close()
+    ring.close()
+
+
+def _count_queue(queue: multiprocessing.Queue, messages: int, ready):
+    ready.set()
+    total = 0
+    for _ in range(messages):
+        total += len(queue.get())
+
+
+def benchmark_transport(messages: int = 200000, size: int = 128, consumers: int = 2):
+    """共享内存环形缓冲区与 multiprocessing.Queue 的跨进程吞吐量对比"""
+    payload = os.urandom(size)
+    ring = SharedRing(slots=4096, slot_size=size, consumers=consumers)
+    try:
+        producer = RingProducer(ring)
+        events = [multiprocessing.Event() for _ in range(consumers)]
+        for index in range(consumers):
+            ring.register(index, 0)
+        workers = [multiprocessing.Process(target=_count_ring, args=(ring.attach_args(), i, messages, events[i]))
+                   for i in range(consumers)]
+        for worker in workers:
+            worker.start()
+        for event in events:
+            event.wait()
+        start = time.perf_counter()
+        for _ in range(messages):
+            producer.publish(payload)
+        for worker in workers:
+            worker.join()
+        ring_elapsed = time.perf_counter() - start
+    finally:
+        ring.close()
+        ring.unlink()
+
+    queues = [multiprocessing.Queue(4096) for _ in range(consumers)]
+    events = [multiprocessing.Event() for _ in range(consumers)]
+    workers = [multiprocessing.Process(target=_count_queue, args=(queues[i], messages, events[i]))
+               for i in range(consumers)]
+    for worker in workers:
+        worker.start()
+    for event in events:
+        event.wait()
+    start = time.perf_counter()
+    for _ in range(messages):
+        for queue in queues:
+            queue.put(payload)
+    for worker in workers:
+        worker.join()
+    queue_elapsed = time.perf_counter() - start
+    print(f'{consumers} consumers, {size} byte messages: shared ring {messages / ring_elapsed:.0f} messages/s, '
+          f'multiprocessing.Queue {messages / queue_elapsed:.0f} messages/s')
+
 
 if __name__ == '__main__':
     robert = User('Robert')
     john = User('John')
     robert.send_message("How are you?")
     john.send_message("I'm fine. Thank you! And you?")
+    ChatRoom.sink.flush()
@@ -22,7 +22,11 @@
 备忘录模式使用三个类 Memento、Originator 和 CareTaker。Memento 包含了要被恢复的对象的状态。Originator 创建并在 Memento 对象中存储状态。Caretaker 对象负责从 Memento 中恢复对象的状态。
 MementoPatternDemo，我们的演示类使用 CareTaker 和 Originator 对象来显示对象的状态恢复。
 """
+import collections.abc
+import pickle
+import time
 import typing
+import zlib
 
 
 class Memento(object):
@@ -34,17 +38,242 @@ class Memento(object):
         return self._state
 
 
+_MISSING = object()
+_HASH_MASK = (1 << 64) - 1
+
+
+def _hash(key) -> int:
+    return hash(key) & _HASH_MASK
+
+
+def _popcount(value: int) -> int:
+    return bin(value).count('1')
+
+
+class _Bucket(object):
+    """同一哈希值下的键值对，哈希冲突时包含多个"""
+    __slots__ = ('hash', 'pairs')
+
+    def __init__(self, key_hash: int, pairs: tuple):
+        self.hash = key_hash
+        self.pairs = pairs
+
+
+class _Node(object):
+    """位图索引节点，每层消耗 5 位哈希，children 只保存存在的分支"""
+    __slots__ = ('bitmap', 'children')
+
+    def __init__(self, bitmap: int, children: tuple):
+        self.bitmap = bitmap
+        self.children = children
+
+    def _slot(self, key_hash: int, shift: int) -> typing.Tuple[int, int]:
+        bit = 1 << ((key_hash >> shift) & 31)
+        return bit, _popcount(self.bitmap & (bit - 1))
+
+    def find(self, key_hash: int, shift: int, key, default):
+        node = self
+        while True:
+            bit, index = node._slot(key_hash, shift)
+            if not node.bitmap & bit:
+                return default
+            child = node.children[index]
+            if isinstance(child, _Bucket):
+                if child.hash == key_hash:
+                    for item_key, value in child.pairs:
+                        if item_key is key or item_key == key:
+                            return value
+                return default
+            node, shift = child, shift + 5
+
+    def assoc(self, key_hash: int, shift: int, key, value) -> typing.Tuple['_Node', bool]:
+        """返回新节点和是否新增了键，只复制从根到叶子路径上的节点"""
+        bit, index = self._slot(key_hash, shift)
+        children = self.children
+        if not self.bitmap & bit:
+            bucket = _Bucket(key_hash, ((key, value),))
+            return _Node(self.bitmap | bit, children[:index] + (bucket,) + children[index:]), True
+        child = children[index]
+        if isinstance(child, _Node):
+            new_child, added = child.assoc(key_hash, shift + 5, key, value)
+            if new_child is child:
+                return self, False
+        elif child.hash != key_hash:
+            new_child, added = _merge(child, _Bucket(key_hash, ((key, value),)), shift + 5), True
+        else:
+            for position, (item_key, item_value) in enumerate(child.pairs):
+                if item_key is key or item_key == key:
+                    if item_value is value:
+                        return self, False
+                    pairs = child.pairs[:position] + ((key, value),) + child.pairs[position + 1:]
+                    new_child, added = _Bucket(key_hash, pairs), False
+                    break
+            else:
+                new_child, added = _Bucket(key_hash, child.pairs + ((key, value),)), True
+        return _Node(self.bitmap, children[:index] + (new_child,) + children[index + 1:]), added
+
+    def without(self, key_hash: int, shift: int, key) -> typing.Optional[typing.Union['_Node', _Bucket]]:
+        """返回删除键后的节点，键不存在时返回自身，节点为空时返回 None"""
+        bit, index = self._slot(key_hash, shift)
+        if not self.bitmap & bit:
+            return self
+        children = self.children
+        child = children[index]
+        if isinstance(child, _Node):
+            new_child = child.without(key_hash, shift + 5, key)
+            if new_child is child:
+                return self
+            new_child = _collapse(new_child)
+        elif child.hash != key_hash:
+            return self
+        else:
+            pairs = tuple(pair for pair in child.pairs if not (pair[0] is key or pair[0] == key))
+            if len(pairs) == len(child.pairs):
+                return self
+            new_child = _Bucket(key_hash, pairs) if pairs else None
+        if new_child is not None:
+            return _Node(self.bitmap, children[:index] + (new_child,) + children[index + 1:])
+        if len(children) == 1:
+            return None
+        return _Node(self.bitmap & ~bit, children[:index] + children[index + 1:])
+
+    def __iter__(self):
+        for child in self.children:
+            if isinstance(child, _Bucket):
+                yield from child.pairs
+            else:
+                yield from child
+
+
+def _merge(first: _Bucket, second: _Bucket, shift: int) -> _Node:
+    first_index, second_index = (first.hash >> shift) & 31, (second.hash >> shift) & 31
+    if first_index == second_index:
+        return _Node(1 << first_index, (_merge(first, second, shift + 5),))
+    children = (first, second) if first_index < second_index else (second, first)
+    return _Node((1 << first_index) | (1 << second_index), children)
+
+
+def _collapse(node):
+    """删除后只剩一个桶的子节点直接换成这个桶，保持树尽量矮"""
+    if isinstance(node, _Node) and len(node.children) == 1 and isinstance(node.children[0], _Bucket):
+        return node.children[0]
+    return node
+
+
+_EMPTY_NODE = _Node(0, ())
+
+
+class PersistentMap(collections.abc.Mapping):
+    """
+    不可变的 HAMT（哈希数组映射字典树）映射。
+    set / delete 返回新映射，只复制被修改路径上的 O(log32 n) 个节点，其余子树与旧映射共享，
+    所以保存快照只需要保留一个引用。
+    """
+    __slots__ = ('_root', '_size')
+
+    def __init__(self, items=None):
+        self._root = _EMPTY_NODE
+        self._size = 0
+        if items:
+            items = items.items() if isinstance(items, collections.abc.Mapping) else items
+            for key, value in items:
+                self._root, added = self._root.assoc(_hash(key), 0, key, value)
+                self._size += added
+
+    @classmethod
+    def _make(cls, root: _Node, size: int) -> 'PersistentMap':
+        instance = cls.__new__(cls)
+        instance._root = root
+        instance._size = size
+        return instance
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for key, _ in self._root:
+            yield key
+
+    def __getitem__(self, key):
+        value = self._root.find(_hash(key), 0, key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return self._root.find(_hash(key), 0, key, default)
+
+    def __contains__(self, key):
+        return self._root.find(_hash(key), 0, key, _MISSING) is not _MISSING
+
+    def set(self, key, value) -> 'PersistentMap':
+        root, added = self._root.assoc(_hash(key), 0, key, value)
+        if root is self._root:
+            return self
+        return self._make(root, self._size + added)
+
+    def delete(self, key) -> 'PersistentMap':
+        root = self._root.without(_hash(key), 0, key)
+        if root is self._root:
+            raise KeyError(key)
+        return self._make(_EMPTY_NODE if root is None else root, self._size - 1)
+
+    def update(self, items) -> 'PersistentMap':
+        result = self
+        items = items.items() if isinstance(items, collections.abc.Mapping) else items
+        for key, value in items:
+            result = result.set(key, value)
+        return result
+
+    def __reduce__(self):
+        return self.__class__, (dict(self._root),)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self._root)!r})'
+
+
 class Originator(object):
+    """
+    persistent=True 时状态保存在 PersistentMap 中，set / delete 生成新版本，
+    save_state_to_memento 只捕获引用即可安全保存，无需复制整个状态。
+    """
     _state = None
 
+    def __init__(self, persistent: bool = False):
+        self.persistent = persistent
+        if persistent:
+            self._state = PersistentMap()
+
     @property
     def state(self):
         return self._state
 
     @state.setter
     def state(self, state):
+        if self.persistent and not isinstance(state, PersistentMap):
+            state = PersistentMap(state)
         self._state = state
 
+    def get(self, key, default=None):
+        return self._state.get(key, default) if self._state is not None else default
+
+    def set(self, key, value):
+        if self.persistent:
+            self._state = self._state.set(key, value)
+        else:
+            # 可变状态只能整体复制，已保存的备忘录才不会被修改
+            state = dict(self._state or {})
+            state[key] = value
+            self._state = state
+
+    def delete(self, key):
+        if self.persistent:
+            self._state = self._state.delete(key)
+        else:
+            state = dict(self._state or {})
+            del state[key]
+            self._state = state
+
     def save_state_to_memento(self):
         return Memento(self.state)
 
@@ -53,7 +282,10 @@ class Originator(object):
 
 
 class CareTaker(object):
-    mementos: typing.List[Memento] = []
+    def __init__(self, max_count: int = None):
+        # 每个实例独立保存，max_count 限制保留的备忘录数量
+        self.max_count = max_count
+        self.mementos: typing.Deque[Memento] = collections.deque(maxlen=max_count)
 
     def add(self, state):
         self.mementos.append(state)
@@ -61,6 +293,210 @@ class CareTaker(object):
     def get(self, index):
         return self.mementos[index]
 
+    def __len__(self):
+        return len(self.mementos)
+
+
+def _common_length(left: bytes, right: bytes, limit: int) -> int:
+    """二分查找公共前缀长度，切片比较在 C 层完成"""
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if left[low:middle] == right[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _Entry(typing.NamedTuple):
+    """关键帧保存完整状态，增量只保存与上一状态不同的部分"""
+    kind: str
+    prefix: int
+    suffix: int
+    data: bytes
+    compressed: bool
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+
+_KEYFRAME, _BYTES, _DICT = 'keyframe', 'bytes', 'dict'
+
+
+class DeltaCareTaker(CareTaker):
+    """
+    关键帧 + 增量保存状态。
+    dict 状态只保存变化和删除的键，其他状态序列化后只保存去掉公共前缀和后缀的中间部分；
+    每 keyframe_interval 条、状态类型改变或增量不划算时保存一个关键帧，恢复时从最近的关键帧开始重建。
+    超出 max_count 或 max_bytes 时丢弃最旧的记录，必要时把下一条增量提升为关键帧。
+    """
+
+    def __init__(self, max_count: int = None, max_bytes: int = None, keyframe_interval: int = 32,
+                 compress: bool = False, level: int = 6):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.compress = compress
+        self.level = level
+        self.entries: typing.Deque[_Entry] = collections.deque()
+        self.nbytes = 0
+        # 最后一条状态（dict 为各个值的序列化结果，其他状态为整体的序列化结果），用于计算下一条增量
+        self._tail = None
+        self._since_keyframe = 0
+
+    def _entry(self, kind: str, data: bytes, prefix: int = 0, suffix: int = 0) -> _Entry:
+        if self.compress and data:
+            packed = zlib.compress(data, self.level)
+            if len(packed) < len(data):
+                return _Entry(kind, prefix, suffix, packed, True)
+        return _Entry(kind, prefix, suffix, data, False)
+
+    @staticmethod
+    def _unpack(entry: _Entry) -> bytes:
+        return zlib.decompress(entry.data) if entry.compressed else entry.data
+
+    @staticmethod
+    def _dumps(value) -> bytes:
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _encode(self, state) -> typing.Tuple[_Entry, typing.Any]:
+        previous = self._tail
+        keyframe = previous is None or self._since_keyframe >= self.keyframe_interval - 1
+        if isinstance(state, dict):
+            # 比较序列化后的值，原地修改过的嵌套对象也能被发现
+            tail = {key: self._dumps(value) for key, value in state.items()}
+            if keyframe or not isinstance(previous, dict):
+                return self._entry(_KEYFRAME, self._dumps(state)), tail
+            changed = {key: value for key, value in tail.items() if previous.get(key) != value}
+            removed = [key for key in previous if key not in tail]
+            if len(changed) + len(removed) > len(state) // 2:
+                return self._entry(_KEYFRAME, self._dumps(state)), tail
+            return self._entry(_DICT, self._dumps((changed, removed))), tail
+
+        raw = self._dumps(state)
+        if keyframe or not isinstance(previous, bytes):
+            return self._entry(_KEYFRAME, raw), raw
+        limit = min(len(previous), len(raw))
+        prefix = _common_length(previous, raw, limit)
+        suffix = _common_length(previous[::-1], raw[::-1], limit - prefix)
+        middle = raw[prefix:len(raw) - suffix]
+        if len(middle) * 2 > len(raw):
+            # 改动过大，直接存关键帧
+            return self._entry(_KEYFRAME, raw), raw
+        return self._entry(_BYTES, middle, prefix, suffix), raw
+
+    def add(self, state: Memento):
+        entry, self._tail = self._encode(state.state)
+        self._since_keyframe = 0 if entry.kind == _KEYFRAME else self._since_keyframe + 1
+        self.entries.append(entry)
+        self.nbytes += entry.nbytes
+        self._retain()
+
+    def _retain(self):
+        while len(self.entries) > 1 and (
+                self.max_count is not None and len(self.entries) > self.max_count or
+                self.max_bytes is not None and self.nbytes > self.max_bytes):
+            following = self.entries[1]
+            if following.kind != _KEYFRAME:
+                # 最旧的记录是后续增量的基准，先把下一条重建为关键帧
+                self.entries[1] = entry = self._entry(_KEYFRAME, self._dumps(self._restore(1)))
+                self.nbytes += entry.nbytes - following.nbytes
+            self.nbytes -= self.entries.popleft().nbytes
+
+    def _restore(self, index: int):
+        start = index
+        while self.entries[start].kind != _KEYFRAME:
+            start -= 1
+        raw = self._unpack(self.entries[start])
+        if start == index or self.entries[start + 1].kind == _BYTES:
+            for position in range(start + 1, index + 1):
+                entry = self.entries[position]
+                raw = raw[:entry.prefix] + self._unpack(entry) + raw[len(raw) - entry.suffix:]
+            return pickle.loads(raw)
+        state = pickle.loads(raw)
+        for position in range(start + 1, index + 1):
+            changed, removed = pickle.loads(self._unpack(self.entries[position]))
+            state.update((key, pickle.loads(value)) for key, value in changed.items())
+            for key in removed:
+                del state[key]
+        return state
+
+    def get(self, index: int) -> Memento:
+        size = len(self.entries)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('memento index out of range')
+        return Memento(self._restore(index))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _sizeof(state) -> int:
+    return len(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+
+def benchmark(keys: int = 5000, saves: int = 200, changes: int = 5, restores: int = 200):
+    """每次修改少量字段后保存，对比完整复制与关键帧 + 增量的内存占用和恢复延迟"""
+    import random
+
+    rng = random.Random(0)
+    state = {f'key-{index}': index for index in range(keys)}
+    caretakers = {
+        'full copy': CareTaker(),
+        'delta': DeltaCareTaker(),
+        'delta + zlib': DeltaCareTaker(compress=True),
+    }
+    originator = Originator()
+    for _ in range(saves):
+        for _ in range(changes):
+            state[f'key-{rng.randrange(keys)}'] = rng.random()
+        originator.state = dict(state)
+        for care_taker in caretakers.values():
+            care_taker.add(originator.save_state_to_memento())
+
+    indexes = [rng.randrange(saves) for _ in range(restores)]
+    for name, care_taker in caretakers.items():
+        if isinstance(care_taker, DeltaCareTaker):
+            nbytes = care_taker.nbytes
+        else:
+            nbytes = sum(_sizeof(memento.state) for memento in care_taker.mementos)
+        start = time.perf_counter()
+        for index in indexes:
+            originator.get_state_from_memento(care_taker.get(index))
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {saves} saves, {nbytes / 1024:.0f} KiB stored, '
+              f'{elapsed / restores * 1e6:.0f} us per restore')
+    assert originator.state == caretakers['full copy'].get(indexes[-1]).state
+
+
+def benchmark_persistent(keys: int = 10000, mutations: int = 2000):
+    """每次修改后都保存快照，对比复制 dict 与 PersistentMap 的耗时和保留内存"""
+    import random
+    import tracemalloc
+
+    initial = {f'key-{index}': index for index in range(keys)}
+    for persistent in (False, True):
+        rng = random.Random(0)
+        originator = Originator(persistent=persistent)
+        originator.state = initial
+        care_taker = CareTaker()
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(mutations):
+            originator.set(f'key-{rng.randrange(keys)}', rng.random())
+            care_taker.add(originator.save_state_to_memento())
+        elapsed = time.perf_counter() - start
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        name = 'PersistentMap' if persistent else 'dict copy'
+        print(f'{name}: {mutations} snapshots of {keys} keys in {elapsed * 1000:.0f} ms, '
+              f'{retained / 1024 / 1024:.1f} MiB retained')
+    assert dict(care_taker.get(0).state.items()) != dict(care_taker.get(-1).state.items())
+
 
 if __name__ == '__main__':
     originator = Originator()
@@ -24,6 +24,18 @@
 ProxyPatternDemo，我们的演示类使用 ProxyImage 来获取要加载的 Image 对象，并按照需求进行显示。
 """
 import abc
+import collections
+import mmap
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+import typing
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
 
 
 class Image(metaclass=abc.ABCMeta):
@@ -32,28 +44,552 @@ class Image(metaclass=abc.ABCMeta):
         """展示"""
 
 
+class MappedFile(object):
+    """
+    只读内存映射文件，同一文件只映射一次，按引用计数在多个 RealImage 之间共享。
+    """
+    _files: typing.Dict[str, 'MappedFile'] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.refs = 0
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # 空文件无法映射
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.view = memoryview(self._mmap) if self._mmap is not None else memoryview(b'')
+
+    @classmethod
+    def open(cls, filename: str) -> 'MappedFile':
+        """获取文件的共享映射"""
+        path = os.path.realpath(filename)
+        with cls._lock:
+            mapped = cls._files.get(path)
+            if mapped is None:
+                mapped = cls._files[path] = cls(path)
+            mapped.refs += 1
+        return mapped
+
+    def release(self):
+        """释放一次引用，最后一次引用释放时关闭映射"""
+        with self._lock:
+            self.refs -= 1
+            if self.refs:
+                return
+            del self._files[self.path]
+        self.view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 仍有切片在使用，交给垃圾回收关闭
+                pass
+
+
 class RealImage(Image):
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, use_mmap: bool = False):
         self.filename = filename
+        self.use_mmap = use_mmap
+        self.data: typing.Union[bytes, memoryview] = b''
+        self._release = None
         self.load()
 
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
     def display(self):
         print(f'display: {self.filename}')
 
     def load(self):
         print(f'loading: {self.filename}')
+        if not os.path.isfile(self.filename):
+            return
+        if self.use_mmap:
+            mapped = MappedFile.open(self.filename)
+            self.data = mapped.view
+            self._release = weakref.finalize(self, mapped.release)
+        else:
+            with open(self.filename, 'rb') as f:
+                self.data = f.read()
+
+    def as_array(self):
+        """以 NumPy 数组视图访问数据，不复制"""
+        import numpy
+        return numpy.frombuffer(self.data, dtype=numpy.uint8)
+
+    def close(self):
+        """释放共享映射"""
+        if self._release is not None:
+            self._release()
+        self.data = b''
+
+
+class ImageCache(object):
+    """
+    线程安全的 LRU 图片缓存，按已加载图片的总字节数限制容量。
+    同一文件的并发加载只执行一次（single-flight），其余调用者等待同一结果；被淘汰的图片下次访问时重新加载。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, loader: typing.Callable[[str], RealImage] = RealImage,
+                 on_evict: typing.Callable[[str, RealImage], None] = None):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        # 淘汰监听器，多个预加载器可以共用同一个缓存
+        self.listeners: typing.List[typing.Callable[[str, RealImage], None]] = []
+        if on_evict is not None:
+            self.listeners.append(on_evict)
+        self.nbytes = 0
+        self._images: typing.Dict[str, RealImage] = collections.OrderedDict()
+        self._loading: typing.Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._images
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def get(self, filename: str) -> RealImage:
+        """获取图片，未缓存时加载"""
+        with self._lock:
+            image = self._images.get(filename)
+            if image is not None:
+                self._images.move_to_end(filename)
+                return image
+            future = self._loading.get(filename)
+            if future is None:
+                future = self._loading[filename] = Future()
+                loading = True
+            else:
+                loading = False
+        if not loading:
+            return future.result()
+        try:
+            image = self.loader(filename)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[filename]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[filename]
+            evicted = self._put(filename, image)
+        future.set_result(image)
+        self._evicted(evicted)
+        return image
+
+    def _put(self, filename: str, image: RealImage) -> typing.List[typing.Tuple[str, RealImage]]:
+        """在锁内放入图片，返回被淘汰的图片"""
+        evicted = []
+        if image.nbytes > self.max_bytes:
+            # 单张超过上限的图片不缓存
+            return evicted
+        while self._images and self.nbytes + image.nbytes > self.max_bytes:
+            old_filename, old_image = self._images.popitem(last=False)
+            self.nbytes -= old_image.nbytes
+            evicted.append((old_filename, old_image))
+        self._images[filename] = image
+        self.nbytes += image.nbytes
+        return evicted
+
+    def add_listener(self, listener: typing.Callable[[str, RealImage], None]):
+        """注册淘汰监听器"""
+        with self._lock:
+            self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener: typing.Callable[[str, RealImage], None]):
+        """移除淘汰监听器"""
+        with self._lock:
+            self.listeners = [item for item in self.listeners if item != listener]
+
+    def _evicted(self, evicted: typing.List[typing.Tuple[str, RealImage]]):
+        listeners = self.listeners
+        for filename, image in evicted:
+            for listener in listeners:
+                listener(filename, image)
+
+    def invalidate(self, filename: str):
+        """移除图片"""
+        with self._lock:
+            image = self._images.pop(filename, None)
+            if image is None:
+                return
+            self.nbytes -= image.nbytes
+        self._evicted([(filename, image)])
 
 
 class ProxyImage(Image):
-    real_image = None
+    cache = ImageCache()
 
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, cache: ImageCache = None):
         self.filename = filename
+        if cache is not None:
+            self.cache = cache
 
     def display(self):
-        if self.real_image is None:
-            self.real_image = RealImage(self.filename)
-        self.real_image.display()
+        self.cache.get(self.filename).display()
+
+
+class ImagePrefetcher(object):
+    """
+    根据提示（如画廊中接下来的 N 张图片）在线程池中后台预加载图片。
+    display 时图片已就绪则直接展示，仍在加载则只等待剩余的加载时间。
+    """
+
+    def __init__(self, cache: ImageCache = None, max_workers: int = 4):
+        self.cache = cache if cache is not None else ProxyImage.cache
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        # 已预加载但尚未展示的图片
+        self._pending: typing.Set[str] = set()
+        self.prefetched = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted = 0
+        self.cache.add_listener(self._evicted)
+
+    def hint(self, filenames: typing.Iterable[str]):
+        """提示即将展示的图片"""
+        for filename in filenames:
+            with self._lock:
+                if filename in self._pending or filename in self.cache:
+                    continue
+                self._pending.add(filename)
+                self.prefetched += 1
+            self._executor.submit(self.cache.get, filename).add_done_callback(
+                lambda future, filename=filename: self._loaded(filename, future))
+
+    def _loaded(self, filename: str, future: Future):
+        if future.exception() is not None:
+            with self._lock:
+                self._pending.discard(filename)
+
+    def _evicted(self, filename: str, image: RealImage):
+        with self._lock:
+            if filename in self._pending:
+                self._pending.discard(filename)
+                self.wasted += 1
+
+    def display(self, filename: str):
+        """展示图片并记录预加载是否命中"""
+        with self._lock:
+            if filename in self._pending:
+                self._pending.discard(filename)
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.cache.get(filename).display()
+
+    def metrics(self) -> typing.Dict[str, typing.Union[int, float]]:
+        """预加载命中率与浪费的加载次数"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'prefetched': self.prefetched,
+                'hits': self.hits,
+                'misses': self.misses,
+                'wasted': self.wasted,
+                'pending': len(self._pending),
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def close(self):
+        self._executor.shutdown()
+        self.cache.remove_listener(self._evicted)
+        with self._lock:
+            # 关闭时仍未展示的预加载同样算作浪费
+            self.wasted += len(self._pending)
+            self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PrefetchingProxyImage(ProxyImage):
+    def __init__(self, filename: str, prefetcher: ImagePrefetcher):
+        super().__init__(filename, prefetcher.cache)
+        self.prefetcher = prefetcher
+
+    def display(self):
+        self.prefetcher.display(self.filename)
+
+
+_COUNT = struct.Struct('!I')
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def send_frame(sock: socket.socket, items: typing.Sequence[bytes]):
+    """发送一帧：条目数 + 每个条目的长度和内容"""
+    parts = [_COUNT.pack(len(items))]
+    for item in items:
+        parts.append(_COUNT.pack(len(item)))
+        parts.append(item)
+    sock.sendall(b''.join(parts))
+
+
+def recv_frame(sock: socket.socket) -> typing.List[bytes]:
+    """接收一帧"""
+    count, = _COUNT.unpack(_recv_exact(sock, _COUNT.size))
+    items = []
+    for _ in range(count):
+        size, = _COUNT.unpack(_recv_exact(sock, _COUNT.size))
+        items.append(_recv_exact(sock, size))
+    return items
+
+
+class ImageServer(object):
+    """
+    本地图片服务替身，供测试和吞吐量基准离线使用。
+    每个请求帧是一批文件名，响应帧按相同顺序返回图片内容，不存在的图片返回空内容。
+    """
+
+    def __init__(self, images: typing.Dict[str, bytes] = None, root: str = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.images = images if images is not None else {}
+        self.root = root
+        self.batches = 0
+        self.requests = 0
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                while True:
+                    try:
+                        names = recv_frame(self.request)
+                    except ConnectionError:
+                        return
+                    send_frame(self.request, [server.read(name.decode()) for name in names])
+                    server.batches += 1
+                    server.requests += len(names)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self) -> typing.Tuple[str, int]:
+        return self._server.server_address
+
+    def read(self, filename: str) -> bytes:
+        """读取图片内容"""
+        data = self.images.get(filename)
+        if data is None and self.root is not None:
+            root = os.path.realpath(self.root)
+            path = os.path.realpath(os.path.join(root, filename))
+            # 文件名来自客户端，解析后必须仍在 root 之内
+            if os.path.commonpath([root, path]) == root and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+        return data or b''
+
+    def start(self) -> 'ImageServer':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class ConnectionPool(object):
+    """TCP 连接池，连接按需创建并复用，出错的连接直接丢弃"""
+
+    def __init__(self, address: typing.Tuple[str, int], size: int = 4, timeout: float = 10):
+        self.address = address
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self) -> socket.socket:
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            sock = socket.create_connection(self.address, self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def release(self, sock: socket.socket, broken: bool = False):
+        if broken:
+            sock.close()
+        else:
+            self._idle.put(sock)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class RemoteImageClient(object):
+    """
+    远程图片客户端：并发的获取请求在 max_delay 内合并为一批（同名只取一次），经连接池发送。
+    """
+
+    def __init__(self, address: typing.Tuple[str, int], pool_size: int = 4, max_batch: int = 64,
+                 max_delay: float = 0.001):
+        self.pool = ConnectionPool(address, pool_size)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.closed = False
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(pool_size)
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+
+    def fetch(self, filename: str) -> Future:
+        """获取图片内容"""
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise RuntimeError('cannot fetch after close')
+            self._queue.put((filename, future))
+        return future
+
+    def _collect(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch: typing.Dict[str, typing.List[Future]] = {item[0]: [item[1]]}
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.setdefault(item[0], []).append(item[1])
+            self.batches += 1
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch: typing.Dict[str, typing.List[Future]]):
+        names = list(batch)
+        sock = None
+        try:
+            sock = self.pool.acquire()
+            send_frame(sock, [name.encode() for name in names])
+            results = recv_frame(sock)
+            if len(results) != len(names):
+                raise ConnectionError(f'expected {len(names)} images, got {len(results)}')
+        except BaseException as e:
+            if sock is not None:
+                self.pool.release(sock, broken=True)
+            for futures in batch.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        self.pool.release(sock)
+        for name, data in zip(names, results):
+            for future in batch[name]:
+                future.set_result(data)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown()
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RemoteImage(Image):
+    """远程代理：首次展示时从图片服务获取内容"""
+
+    def __init__(self, filename: str, client: RemoteImageClient):
+        self.filename = filename
+        self.client = client
+        self.data = None
+
+    def display(self):
+        if self.data is None:
+            self.data = self.client.fetch(self.filename).result()
+        print(f'display: {self.filename}')
+
+
+def benchmark(requests: int = 100000, images: int = 1000, size: int = 1024, concurrency: int = 64):
+    """对本地图片服务替身做吞吐量基准"""
+    with ImageServer({f'{i}.jpg': os.urandom(size) for i in range(images)}) as server:
+        with RemoteImageClient(server.address) as client:
+            start = time.perf_counter()
+            for offset in range(0, requests, concurrency):
+                futures = [client.fetch(f'{i % images}.jpg')
+                           for i in range(offset, min(offset + concurrency, requests))]
+                for future in futures:
+                    future.result()
+            elapsed = time.perf_counter() - start
+            print(f'remote fetch: {requests / elapsed:.0f} images/s, '
+                  f'{requests / client.batches:.1f} images/batch, {server.batches} round trips')
+
+
+def check_remote_client():
+    """用本地图片服务替身检查远程客户端的合并、缺失图片、错误响应和关闭后的行为"""
+    with ImageServer({'a.jpg': b'a', 'b.jpg': b'b'}) as server:
+        with RemoteImageClient(server.address, max_delay=0.01) as client:
+            futures = [client.fetch(name) for name in ('a.jpg', 'b.jpg', 'a.jpg', 'missing.jpg')]
+            assert [future.result(5) for future in futures] == [b'a', b'b', b'a', b'']
+            assert client.batches == 1
+        try:
+            client.fetch('a.jpg')
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('fetch after close should fail')
+
+    class ShortReply(socketserver.BaseRequestHandler):
+        def handle(self):
+            names = recv_frame(self.request)
+            send_frame(self.request, names[:-1])
+
+    short_server = socketserver.TCPServer(('127.0.0.1', 0), ShortReply)
+    threading.Thread(target=short_server.handle_request, daemon=True).start()
+    with RemoteImageClient(short_server.server_address, max_delay=0.01) as client:
+        futures = [client.fetch(name) for name in ('a.jpg', 'b.jpg')]
+        for future in futures:
+            assert isinstance(future.exception(5), ConnectionError)
+    short_server.server_close()
 
 
 if __name__ == '__main__':
@@ -61,3 +597,16 @@ if __name__ == '__main__':
     image.display()
     print()
     image.display()
+    print()
+
+    with ImagePrefetcher(ImageCache()) as prefetcher:
+        gallery = [PrefetchingProxyImage(f'gallery_{i}.jpg', prefetcher) for i in range(3)]
+        prefetcher.hint(image.filename for image in gallery[1:])
+        for image in gallery:
+            image.display()
+        print(prefetcher.metrics())
+    print()
+
+    with ImageServer({'remote.jpg': b'remote image'}) as image_server:
+        with RemoteImageClient(image_server.address) as image_client:
+            RemoteImage('remote.jpg', image_client).display()